@@ -0,0 +1,101 @@
+import os
+import sqlite3
+from datetime import date
+from queue import Empty, SimpleQueue
+from threading import Event, Thread
+from time import time
+
+from xlsx import xlsx_file_create_new, xlsx_file_write_session
+
+EVENTS_FILE = 'attendance_events.sqlite'
+
+
+class AttendanceLog:
+    """
+    Append-only log of recognition events with a background flusher.
+
+    record() only puts (timestamp, identity index, distance, track id) into
+    an in-memory queue, so it is safe to call from the recognition loop.
+    A dedicated thread writes the queued events in batches into an SQLite
+    database in the class folder every flush_interval seconds. Every
+    xlsx_interval seconds and on stop() it aggregates the events of the
+    session into presence and updates attendance.xlsx: a person is present
+    if they were seen in at least min_events events. identity is the index
+    of the known face, -1 for unknown faces (the UNKNOWN row).
+    """
+
+    def __init__(self, path, known_face_names, session=None,
+                 flush_interval=1, xlsx_interval=60, min_events=1):
+        self.path = path
+        self.known_face_names = list(known_face_names)
+        self.session = session or date.today().isoformat()
+        self.flush_interval = flush_interval
+        self.xlsx_interval = xlsx_interval
+        self.min_events = min_events
+        self.events_file = os.path.join(path, EVENTS_FILE)
+        self._queue = SimpleQueue()
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self.run, name='AttendanceLog', args=(),
+                              daemon=True)
+        self._thread.start()
+        return self
+
+    def record(self, identity, distance, track_id, timestamp=None):
+        self._queue.put((timestamp or time(), identity, distance, track_id))
+
+    def run(self):
+        # the connection belongs to this thread
+        connection = sqlite3.connect(self.events_file)
+        connection.execute('CREATE TABLE IF NOT EXISTS events ('
+                           'session TEXT, timestamp REAL, identity INTEGER, '
+                           'distance REAL, track_id INTEGER)')
+        connection.commit()
+        last_xlsx = time()
+        while True:
+            stopping = self._stop_event.wait(self.flush_interval)
+            self.flush(connection)
+            if stopping or time() - last_xlsx >= self.xlsx_interval:
+                self.update_xlsx(connection)
+                last_xlsx = time()
+            if stopping:
+                break
+        connection.close()
+
+    def flush(self, connection):
+        events = []
+        while True:
+            try:
+                events.append((self.session,) + self._queue.get_nowait())
+            except Empty:
+                break
+        if events:
+            connection.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?)',
+                                   events)
+            connection.commit()
+
+    def presence(self, connection):
+        """Return the set of identities present in the session."""
+        rows = connection.execute(
+            'SELECT identity FROM events WHERE session = ? '
+            'GROUP BY identity HAVING COUNT(*) >= ?',
+            (self.session, self.min_events))
+        return {identity for identity, in rows}
+
+    def update_xlsx(self, connection):
+        present = self.presence(connection)
+        names = {self.known_face_names[identity] if identity >= 0
+                 else 'UNKNOWN' for identity in present}
+        if not os.path.isfile(os.path.join(self.path, 'attendance.xlsx')):
+            xlsx_file_create_new(self.path, list(self.known_face_names))
+        # only the column of this session is rewritten, the history is
+        # streamed through
+        xlsx_file_write_session(self.path, self.session, names)
+
+    def stop(self):
+        """Flush the remaining events, update attendance.xlsx and stop."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,335 @@
+"""
+Offline benchmark of the recognition pipeline.
+
+Replays a recorded meeting (or synthetic frames with pasted reference
+faces) through the same stages face_recognition() uses, for every
+combination of resize, frame_rate and gallery size, and saves the results
+as JSON so they can be compared across commits.
+
+Examples:
+    python benchmark.py --source "video/Video conference at ZOOM.mp4" \\
+        --labels video/labels.json --class-path class_trofim
+    python benchmark.py --source synthetic --class-path class_trofim \\
+        --resize 1 2 --frame-rate 10 100 --gallery-size 0 10000
+
+A labels file is JSON mapping frame numbers to the names visible on the
+frame: {"0": ["Anna", "Bob"], "25": ["Anna"]}. Only labeled frames are
+scored. For the synthetic source the pasted faces are the labels.
+
+With --quality every run is repeated with the face-quality gate, to
+compare the number of encoded faces and the precision/recall with and
+without it. With --changes every run is repeated with the change
+detector, to compare the number of detector calls and the detected area.
+
+With --xlsx the attendance workbook functions are benchmarked instead, on
+a generated sheet (10000 people x 365 sessions by default):
+    python benchmark.py --xlsx --xlsx-size 10000 365
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import shutil
+import subprocess
+import tempfile
+import traceback
+from itertools import product
+from queue import Empty
+from time import time
+
+import cv2 as cv
+import numpy as np
+
+from changes import ChangeDetector
+from classes import SyntheticCapture, open_frame_source
+from gallery import load_gallery, load_samples
+from matcher import FaceMatcher
+from quality import FaceQuality
+from recognition import FaceRecognizer
+from setup_class import identity_name, list_images
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'count': len(values), 'p50': p50, 'p95': p95, 'p99': p99,
+            'mean': float(np.mean(values))}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def grow_gallery(names, encodings, size, seed=0):
+    """
+    Pad the gallery with random distractor identities up to size faces.
+    Distractors follow the mean and spread of the real encodings, so they
+    cost the same to match but never match a real face.
+    """
+    if size <= len(names):
+        return names, encodings
+    rng = np.random.default_rng(seed)
+    extra = size - len(names)
+    encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, 128)
+    if len(encodings):
+        mean, std = encodings.mean(axis=0), encodings.std(axis=0) + 0.05
+    else:
+        mean, std = np.zeros(128), np.full(128, 0.1)
+    distractors = rng.normal(mean, std, size=(extra, 128))
+    return (names + [f'distractor_{i}' for i in range(extra)],
+            np.vstack([encodings, distractors]))
+
+
+def reference_faces(path):
+    # the enrolled images, also the ones in the person subfolders
+    faces = []
+    for file in list_images(path):
+        image = cv.imread(f'{path}/{file}')
+        if image is not None:
+            faces.append((identity_name(file), image))
+    return faces
+
+
+def open_source(args, faces):
+    if args.source == 'synthetic':
+        return SyntheticCapture(args.width, args.height, faces=faces,
+                                frames=args.frames)
+    return open_frame_source(args.source)
+
+
+def load_labels(path):
+    if not path:
+        return {}
+    with open(path) as file:
+        return {int(frame): set(names) for frame, names in json.load(file).items()}
+
+
+def run(source, matcher, resize, frame_rate, frames, labels, quality=False,
+        changes=False):
+    """
+    Process up to frames screenshots of source and return the measurements.
+    """
+    recognizer = FaceRecognizer(matcher, resize, frame_rate,
+                                quality=FaceQuality() if quality else None,
+                                changes=ChangeDetector() if changes else None)
+    pixels = 0
+    stages = {}
+    totals = []
+    true_positives = false_positives = false_negatives = 0
+    start_time = time()
+    frame_number = 0
+    while frame_number < frames:
+        screenshot = source.get_screenshot()
+        if screenshot is None:
+            break
+        time_frame = time()
+        _, face_names = recognizer.process(screenshot)
+        totals.append(time() - time_frame)
+        if recognizer.detected:
+            pixels += screenshot.shape[0] * screenshot.shape[1] \
+                / recognizer.resize ** 2
+        for stage, duration in recognizer.timings.items():
+            stages.setdefault(stage, []).append(duration)
+
+        truth = labels.get(frame_number)
+        if truth is None and isinstance(source, SyntheticCapture):
+            truth = {name for name, _ in source.last_labels}
+        if truth is not None:
+            found = {name for name in face_names
+                     if name not in (None, FaceMatcher.unknown_name)}
+            true_positives += len(found & truth)
+            false_positives += len(found - truth)
+            false_negatives += len(truth - found)
+        frame_number += 1
+    elapsed = time() - start_time
+    found = true_positives + false_positives
+    expected = true_positives + false_negatives
+    return {'frames': frame_number,
+            'fps': frame_number / elapsed if elapsed else 0,
+            'encoded_faces': recognizer.encoded,
+            'encodes_per_frame':
+                recognizer.encoded / frame_number if frame_number else 0,
+            'quality_decisions': recognizer.quality.decisions
+            if quality else None,
+            'detector_calls': recognizer.detector_calls,
+            # share of the scheduled detections' pixels the detector saw
+            'detected_area': recognizer.detected_pixels / pixels
+            if pixels else None,
+            'end_to_end': percentiles(totals),
+            'stages': {stage: percentiles(values)
+                       for stage, values in stages.items()},
+            'precision': true_positives / found if found else None,
+            'recall': true_positives / expected if expected else None}
+
+
+def run_point(args, names, encodings, faces, labels, resize, frame_rate,
+              gallery_size, quality, changes):
+    """One run of the resize x frame_rate x gallery size x ... matrix."""
+    gallery_names, gallery_encodings = grow_gallery(names, encodings,
+                                                    gallery_size)
+    # distractors have no samples, so the samples are only used for the
+    # class gallery
+    samples = load_samples(args.class_path) \
+        if len(gallery_names) == len(names) else {}
+    matcher = FaceMatcher(gallery_encodings, gallery_names, args.tolerance,
+                          **samples)
+    source = open_source(args, faces)
+    result = run(source, matcher, resize, frame_rate, args.frames, labels,
+                 quality, changes)
+    source.release()
+    result.update(resize=resize, frame_rate=frame_rate,
+                  gallery_size=len(gallery_names), quality=quality,
+                  changes=changes)
+    return result
+
+
+def _measure(queue, function, args, keep_result):
+    # runs in a fresh process, so peak RSS belongs to this operation only
+    start_time = time()
+    try:
+        result = function(*args)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+        return
+    measurement = {'seconds': time() - start_time,
+                   'peak_rss_mb': peak_rss_mb()}
+    if keep_result:
+        measurement['result'] = result
+    queue.put(measurement)
+
+
+def measure(function, *args, keep_result=False):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_measure,
+                              args=(queue, function, args, keep_result))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            # killed or crashed without a result (e.g. out of memory)
+            if not process.is_alive() and queue.empty():
+                raise Exception('Benchmark process exited with code {}'
+                                .format(process.exitcode))
+    process.join()
+    if 'error' in result:
+        raise Exception('Benchmark process failed:\n' + result['error'])
+    return result
+
+
+def xlsx_benchmark(people, sessions):
+    """
+    Time the in-memory and the streaming attendance.xlsx functions on a
+    generated sheet of people x sessions.
+    """
+    rng = np.random.default_rng(0)
+    dates = [f'session_{i:04d}' for i in range(sessions)]
+    data = {f'person_{i:06d}': dict(zip(dates, rng.integers(0, 2, sessions)
+                                        .tolist()))
+            for i in range(people)}
+    present = {name for name in data if rng.random() < 0.8}
+    folder = tempfile.mkdtemp()
+    results = {}
+    try:
+        import xlsx
+        results['write'] = measure(xlsx.xlsx_file_write, folder, data)
+        results['read'] = measure(xlsx.xlsx_file_read, folder)
+        results['write_stream'] = measure(xlsx.xlsx_file_write_stream, folder,
+                                          data)
+        results['read_stream'] = measure(xlsx.xlsx_file_read_stream, folder)
+        results['append_session_stream'] = measure(
+            xlsx.xlsx_file_write_session, folder, 'session_new', present)
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default='synthetic',
+                        help='video file, image folder or "synthetic"')
+    parser.add_argument('--class-path', default='class_trofim',
+                        help='class folder with names.npy, face_encodings.npy '
+                             'and the reference images')
+    parser.add_argument('--labels', help='ground-truth labels JSON file')
+    parser.add_argument('--resize', type=float, nargs='+', default=[2])
+    parser.add_argument('--frame-rate', type=int, nargs='+', default=[100])
+    parser.add_argument('--gallery-size', type=int, nargs='+', default=[0],
+                        help='pad the gallery with distractors up to this '
+                             'size (0 = class gallery only)')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--quality', action='store_true',
+                        help='also run every combination with the '
+                             'face-quality gate')
+    parser.add_argument('--changes', action='store_true',
+                        help='also run every combination with the change '
+                             'detector')
+    parser.add_argument('--xlsx', action='store_true',
+                        help='benchmark the attendance.xlsx functions')
+    parser.add_argument('--xlsx-size', type=int, nargs=2,
+                        default=[10000, 365], metavar=('PEOPLE', 'SESSIONS'))
+    args = parser.parse_args()
+
+    if args.xlsx:
+        results = {'commit': git_commit(), 'xlsx_size': args.xlsx_size,
+                   'xlsx': xlsx_benchmark(*args.xlsx_size)}
+        for operation, result in results['xlsx'].items():
+            print(f'{operation}: {result["seconds"]:.1f} sec, '
+                  f'peak RSS {result["peak_rss_mb"]:.0f} MB')
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Results saved into file {args.output}')
+        return
+
+    names, encodings, _ = load_gallery(args.class_path)
+    names = list(names)
+    faces = reference_faces(args.class_path) if args.source == 'synthetic' \
+        else None
+    labels = load_labels(args.labels)
+    results = {'commit': git_commit(), 'source': args.source,
+               'labels': args.labels, 'runs': []}
+    for resize, frame_rate, gallery_size, quality, changes in product(
+            args.resize, args.frame_rate, args.gallery_size,
+            [False, True] if args.quality else [False],
+            [False, True] if args.changes else [False]):
+        # every run gets a fresh process, ru_maxrss is the peak of the
+        # whole process
+        measurement = measure(run_point, args, names, encodings, faces,
+                              labels, resize, frame_rate, gallery_size,
+                              quality, changes, keep_result=True)
+        result = measurement['result']
+        result['peak_rss_mb'] = measurement['peak_rss_mb']
+        results['runs'].append(result)
+        print(f'resize={resize} frame_rate={frame_rate} '
+              f'gallery={result["gallery_size"]} quality={quality} '
+              f'changes={changes}: {result["fps"]:.1f} FPS, '
+              f'p95 {result["end_to_end"].get("p95", 0) * 1000:.1f} ms, '
+              f'{result["encodes_per_frame"]:.2f} encodes/frame, '
+              f'{result["detector_calls"]} detector calls, '
+              f'precision {result["precision"]}, recall {result["recall"]}')
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2, default=float)
+    print(f'Results saved into file {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import cv2 as cv
+import numpy as np
+
+
+def overlaps(box_a, box_b):
+    """Whether two (top, right, bottom, left) boxes overlap."""
+    return box_a[0] < box_b[2] and box_b[0] < box_a[2] \
+        and box_a[3] < box_b[1] and box_b[3] < box_a[1]
+
+
+class ChangeDetector:
+    """
+    Class that finds the regions of a screenshot that changed since the
+    last detection, so the detection only runs where something happened.
+
+    The gray screenshot is reduced to cell_size x cell_size pixels per
+    cell of a rows x cols grid. A cell changed if the mean absolute
+    difference to its reference is more than threshold gray levels. The
+    reference of a cell is only updated when the cell changed, so slow
+    drifts add up until they are noticed. Changed cells grow by one cell
+    (a face can cross a cell border) and are merged into rectangular
+    regions.
+
+    changed_regions() returns [] if nothing changed (the previous boxes
+    and names are still valid), a list of regions to detect in, or None if
+    more than max_changed of the cells changed or there is no reference
+    yet (one detection on the whole screenshot is cheaper then).
+    """
+
+    def __init__(self, grid=(8, 8), threshold=6, max_changed=0.5,
+                 cell_size=8):
+        self.rows, self.cols = grid
+        self.threshold = threshold
+        self.max_changed = max_changed
+        self.cell_size = cell_size
+        self._reference = None
+        self._shape = None
+        self.changed_cells = None  # mask of the cells changed last time
+
+    def _small(self, gray):
+        return cv.resize(gray, (self.cols * self.cell_size,
+                                self.rows * self.cell_size),
+                         interpolation=cv.INTER_AREA).astype(np.int16)
+
+    def reset(self):
+        self._reference = None
+
+    def changed_regions(self, gray):
+        small = self._small(gray)
+        if self._reference is None or gray.shape != self._shape:
+            self._reference = small
+            self._shape = gray.shape
+            self.changed_cells = np.ones((self.rows, self.cols), dtype=bool)
+            return None
+        size = self.cell_size
+        difference = np.abs(small - self._reference).reshape(
+            self.rows, size, self.cols, size).mean(axis=(1, 3))
+        changed = difference > self.threshold
+        self.changed_cells = changed
+        if not changed.any():
+            return []
+        # the changed cells are detected again, so they are the new
+        # reference
+        cells = np.kron(changed, np.ones((size, size), dtype=bool))
+        self._reference[cells] = small[cells]
+        if changed.mean() > self.max_changed:
+            return None
+        grown = cv.dilate(changed.astype(np.uint8), np.ones((3, 3), np.uint8))
+        count, _, stats, _ = cv.connectedComponentsWithStats(grown,
+                                                             connectivity=8)
+        cell_height = gray.shape[0] / self.rows
+        cell_width = gray.shape[1] / self.cols
+        regions = []
+        for left, top, width, height, _ in stats[1:count]:
+            regions.append((int(top * cell_height),
+                            int(round((left + width) * cell_width)),
+                            int(round((top + height) * cell_height)),
+                            int(left * cell_width)))
+        return regions
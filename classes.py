@@ -1,20 +1,59 @@
-from collections import deque
-from threading import Thread
+import os
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Lock, Thread, current_thread
 from time import time
 
 import cv2 as cv
 import face_recognition as fr
 import numpy as np
-import win32con
-import win32gui
-import win32ui
 
+# win32 window capture is only available on Windows. Other frame sources
+# (video files, devices, image folders, synthetic frames) work everywhere.
+try:
+    import win32con
+    import win32gui
+    import win32ui
+except ImportError:
+    win32con = win32gui = win32ui = None
 
-# Class WindowCapture from https://www.youtube.com/watch?v=WymCpVUPWQ4
-class WindowCapture:
-    # properties
+
+class FrameSource:
+    """
+    Base class for the frame sources used by VideoGet.
+
+    get_screenshot() returns a BGR uint8 frame, or None when the source is
+    exhausted. Frames are written into a small pool of preallocated buffers
+    that are reused round-robin, so a returned frame stays valid until
+    buffer_count - 1 further frames have been captured. Copy it if it must
+    live longer than that.
+    """
     width = 0
     height = 0
+    buffer_count = 3
+
+    def _allocate_buffers(self, width, height):
+        self.width = width
+        self.height = height
+        self._buffers = [np.empty((height, width, 3), dtype=np.uint8)
+                         for _ in range(self.buffer_count)]
+        self._buffer_index = 0
+
+    def _next_buffer(self):
+        buffer = self._buffers[self._buffer_index]
+        self._buffer_index = (self._buffer_index + 1) % len(self._buffers)
+        return buffer
+
+    def get_screenshot(self):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+
+# Class WindowCapture from https://www.youtube.com/watch?v=WymCpVUPWQ4
+class WindowCapture(FrameSource):
+    # properties
     hwnd = None
     cropped_x = 0
     cropped_y = 0
@@ -23,6 +62,10 @@ class WindowCapture:
 
     # constructor
     def __init__(self, window_name):
+        if win32gui is None:
+            raise Exception('Window capture needs pywin32 (Windows only). '
+                            'Use a video file, image folder or synthetic '
+                            'source instead.')
         # find the handle for the window we want to capture
         self.hwnd = win32gui.FindWindow(None, window_name)
         if not self.hwnd:
@@ -30,59 +73,68 @@ class WindowCapture:
 
         # get the window size
         window_rect = win32gui.GetWindowRect(self.hwnd)
-        self.width = window_rect[2] - window_rect[0]
-        self.height = window_rect[3] - window_rect[1]
+        width = window_rect[2] - window_rect[0]
+        height = window_rect[3] - window_rect[1]
 
         # account for the window border and titlebar and cut them off
         border_pixels = 8
         titlebar_pixels = 30
-        self.width = self.width - (border_pixels * 2)
-        self.height = self.height - titlebar_pixels - border_pixels
+        width = width - (border_pixels * 2)
+        height = height - titlebar_pixels - border_pixels
         self.cropped_x = border_pixels
         self.cropped_y = titlebar_pixels
+        self._allocate_buffers(width, height)
 
         # set the cropped coordinates offset so we can translate screenshot
         # images into actual screen positions
         self.offset_x = window_rect[0] + self.cropped_x
         self.offset_y = window_rect[1] + self.cropped_y
 
+        # create the device contexts and the bitmap once and reuse them for
+        # every screenshot instead of allocating them per frame
+        self._wDC = win32gui.GetWindowDC(self.hwnd)
+        self._dcObj = win32ui.CreateDCFromHandle(self._wDC)
+        self._cDC = self._dcObj.CreateCompatibleDC()
+        self._dataBitMap = win32ui.CreateBitmap()
+        self._dataBitMap.CreateCompatibleBitmap(self._dcObj, self.width,
+                                                self.height)
+        self._cDC.SelectObject(self._dataBitMap)
+
     def get_screenshot(self):
 
         # get the window image data
-        wDC = win32gui.GetWindowDC(self.hwnd)
-        dcObj = win32ui.CreateDCFromHandle(wDC)
-        cDC = dcObj.CreateCompatibleDC()
-        dataBitMap = win32ui.CreateBitmap()
-        dataBitMap.CreateCompatibleBitmap(dcObj, self.width, self.height)
-        cDC.SelectObject(dataBitMap)
-        cDC.BitBlt((0, 0), (self.width, self.height), dcObj,
-                   (self.cropped_x, self.cropped_y), win32con.SRCCOPY)
+        self._cDC.BitBlt((0, 0), (self.width, self.height), self._dcObj,
+                         (self.cropped_x, self.cropped_y), win32con.SRCCOPY)
 
         # convert the raw data into a format opencv can read
         # dataBitMap.SaveBitmapFile(cDC, 'debug.bmp')
-        signedIntsArray = dataBitMap.GetBitmapBits(True)
-        img = np.fromstring(signedIntsArray, dtype='uint8')
-        img.shape = (self.height, self.width, 4)
-
-        # free resources
-        dcObj.DeleteDC()
-        cDC.DeleteDC()
-        win32gui.ReleaseDC(self.hwnd, wDC)
-        win32gui.DeleteObject(dataBitMap.GetHandle())
+        signedIntsArray = self._dataBitMap.GetBitmapBits(True)
+        img = np.frombuffer(signedIntsArray, dtype='uint8')
+        img = img.reshape((self.height, self.width, 4))
 
         # drop the alpha channel, or cv.matchTemplate() will throw an error like:
         #   error: (-215:Assertion failed) (depth == CV_8U || depth == CV_32F) && type == _templ.type()
         #   && _img.dims() <= 2 in function 'cv::matchTemplate'
-        img = img[..., :3]
-
-        # make image C_CONTIGUOUS to avoid errors that look like:
+        # Copying into a preallocated buffer also makes the image
+        # C_CONTIGUOUS to avoid errors that look like:
         #   File ... in draw_rectangles
         #   TypeError: an integer is required (got type tuple)
         # see the discussion here:
         # https://github.com/opencv/opencv/issues/14866#issuecomment-580207109
-        img = np.ascontiguousarray(img)
+        buffer = self._next_buffer()
+        np.copyto(buffer, img[..., :3])
 
-        return img
+        return buffer
+
+    def release(self):
+        # free resources
+        if self._dataBitMap is None:
+            return
+        self._dcObj.DeleteDC()
+        self._cDC.DeleteDC()
+        win32gui.ReleaseDC(self.hwnd, self._wDC)
+        win32gui.DeleteObject(self._dataBitMap.GetHandle())
+        self._dataBitMap = None
 
     # find the name of the window you're interested in.
     # once you have it, update window_capture()
@@ -106,6 +158,180 @@ class WindowCapture:
         return (pos[0] + self.offset_x, pos[1] + self.offset_y)
 
 
+class VideoFileCapture(FrameSource):
+    """
+    Frame source reading a video file or a capture device with
+    cv.VideoCapture. Frames are decoded straight into the preallocated
+    buffers.
+    """
+
+    def __init__(self, src, loop=False):
+        self.src = src
+        self.loop = loop and not isinstance(src, int)
+        self.capture = cv.VideoCapture(src)
+        if not self.capture.isOpened():
+            raise Exception('Video source not found: {}'.format(src))
+        width = int(self.capture.get(cv.CAP_PROP_FRAME_WIDTH))
+        height = int(self.capture.get(cv.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.capture.get(cv.CAP_PROP_FPS) or 0
+        self._allocate_buffers(width, height)
+
+    def get_screenshot(self):
+        buffer = self._next_buffer()
+        ok, frame = self.capture.read(buffer)
+        if not ok and self.loop:
+            # rewind to the first frame and try once more
+            self.capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read(buffer)
+        if not ok:
+            return None
+        if frame is not buffer:
+            # the decoder allocated a new image (size or type differs from
+            # the buffer), bring it back into the buffer
+            if frame.shape != buffer.shape:
+                frame = cv.resize(frame, (self.width, self.height))
+            np.copyto(buffer, frame)
+        return buffer
+
+    def release(self):
+        self.capture.release()
+
+
+class ImageFolderCapture(FrameSource):
+    """
+    Frame source that plays the images of a folder in name order.
+    Every image is resized to the size of the first one.
+    """
+    extensions = ('.jpg', '.jpeg', '.png', '.bmp')
+
+    def __init__(self, path, loop=True):
+        self.path = path
+        self.loop = loop
+        self.files = sorted(file for file in os.listdir(path)
+                            if file.lower().endswith(self.extensions))
+        if not self.files:
+            raise Exception('No images found in folder: {}'.format(path))
+        self._index = 0
+        first = cv.imread(os.path.join(path, self.files[0]))
+        if first is None:
+            raise Exception('Image can\'t be read: {}'.format(self.files[0]))
+        self._allocate_buffers(first.shape[1], first.shape[0])
+
+    def get_screenshot(self):
+        if self._index == len(self.files):
+            if not self.loop:
+                return None
+            self._index = 0
+        file = self.files[self._index]
+        self._index += 1
+        img = cv.imread(os.path.join(self.path, file))
+        if img is None:
+            raise Exception('Image can\'t be read: {}'.format(file))
+        buffer = self._next_buffer()
+        if img.shape == buffer.shape:
+            np.copyto(buffer, img)
+        else:
+            cv.resize(img, (self.width, self.height), dst=buffer)
+        return buffer
+
+
+class SyntheticCapture(FrameSource):
+    """
+    Deterministic frame generator for headless runs and benchmarks.
+
+    Draws a Zoom-like gallery of grid_size tiles on a dark background.
+    If faces are given as a list of (name, image) pairs they are pasted
+    into the tiles, one per tile, moving slightly from frame to frame.
+    The names and boxes (top, right, bottom, left) of the faces pasted
+    into the last frame are kept in last_labels.
+    """
+
+    def __init__(self, width=1280, height=720, faces=None, grid_size=None,
+                 frames=None, seed=0):
+        self.faces = list(faces or [])
+        if grid_size is None:
+            cols = max(1, int(np.ceil(np.sqrt(len(self.faces)))))
+            rows = max(1, int(np.ceil(len(self.faces) / cols)))
+            grid_size = (rows, cols)
+        self.grid_size = grid_size
+        self.frames = frames
+        self.frame_index = 0
+        self.last_labels = []
+        self._allocate_buffers(width, height)
+
+        # everything random is drawn once here, frames only depend on
+        # the frame index
+        rng = np.random.default_rng(seed)
+        rows, cols = grid_size
+        self._tile_h = height // rows
+        self._tile_w = width // cols
+        self._phases = rng.uniform(0, 2 * np.pi, size=rows * cols)
+        self._faces = []
+        for name, image in self.faces:
+            scale = 0.6 * min(self._tile_h / image.shape[0],
+                              self._tile_w / image.shape[1])
+            size = (max(1, int(image.shape[1] * scale)),
+                    max(1, int(image.shape[0] * scale)))
+            self._faces.append((name, cv.resize(image, size)))
+
+        # the gallery background is drawn once: tiles with a textured
+        # "room" separated by 2 px gaps like in Zoom
+        self._background = np.full((height, width, 3), 26, dtype=np.uint8)
+        for tile in range(rows * cols):
+            top = (tile // cols) * self._tile_h
+            left = (tile % cols) * self._tile_w
+            room = rng.integers(40, 160, size=(self._tile_h - 4,
+                                               self._tile_w - 4, 3),
+                                dtype=np.uint8)
+            self._background[top + 2:top + self._tile_h - 2,
+                             left + 2:left + self._tile_w - 2] = \
+                cv.GaussianBlur(room, (0, 0), 1)
+
+    def get_screenshot(self):
+        if self.frames is not None and self.frame_index >= self.frames:
+            return None
+        buffer = self._next_buffer()
+        np.copyto(buffer, self._background)
+        rows, cols = self.grid_size
+        labels = []
+        for tile, (name, face) in enumerate(self._faces):
+            top = (tile // cols) * self._tile_h
+            left = (tile % cols) * self._tile_w
+            h, w = face.shape[:2]
+            shift = np.sin(self.frame_index / 15 + self._phases[tile])
+            y = top + (self._tile_h - h) // 2 + int(shift * 0.1 * (self._tile_h - h))
+            x = left + (self._tile_w - w) // 2 + int(shift * 0.1 * (self._tile_w - w))
+            buffer[y:y + h, x:x + w] = face
+            labels.append((name, (y, x + w, y + h, x)))
+        self.last_labels = labels
+        self.frame_index += 1
+        return buffer
+
+
+def open_frame_source(src, loop=False):
+    """
+    Create a frame source for src:
+    an existing FrameSource is returned as is, an int or a digit string is a
+    capture device, an existing folder is an image folder, an existing file
+    is a video file, 'synthetic' or 'synthetic:WIDTHxHEIGHT' is the
+    synthetic generator, anything else is a window name.
+    """
+    if isinstance(src, FrameSource):
+        return src
+    if isinstance(src, int) or (isinstance(src, str) and src.isdigit()):
+        return VideoFileCapture(int(src))
+    if os.path.isdir(src):
+        return ImageFolderCapture(src, loop=loop)
+    if os.path.isfile(src):
+        return VideoFileCapture(src, loop=loop)
+    if src == 'synthetic' or src.startswith('synthetic:'):
+        if ':' in src:
+            width, height = (int(x) for x in src.split(':', 1)[1].split('x'))
+            return SyntheticCapture(width, height)
+        return SyntheticCapture()
+    return WindowCapture(src)
+
+
 # Class CountsPerSec from https://nrsyed.com/2018/07/05/multithreading-with-opencv-python-to-improve-video-processing-performance/
 class CountsPerSec:
     """
@@ -130,96 +356,622 @@ class CountsPerSec:
         return self._num_occurrences / elapsed_time if elapsed_time > 0 else 0
 
 
+class Counter(CountsPerSec):
+    """
+    CountsPerSec with a name, for the MetricsRegistry. inc() adds n counts.
+    """
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.start()
+
+    def inc(self, n=1):
+        self._num_occurrences += n
+
+    @property
+    def value(self):
+        return self._num_occurrences
+
+    def snapshot(self):
+        return {'count': self._num_occurrences, 'rate': self.counts_per_sec()}
+
+
+class Gauge:
+    """Metric that holds the last value set, e.g. a queue depth."""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets (upper bounds in seconds), so
+    observing a value costs one bisect and one increment.
+    """
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                       0.5, 1, 2.5, 5)
+
+    def __init__(self, name, buckets=None):
+        self.name = name
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-quantile
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99),
+                'buckets': dict(zip(self.buckets + (float('inf'),),
+                                    self.counts))}
+
+
+class NullMetric:
+    """Metric of a disabled registry, every call does nothing."""
+    name = None
+    value = 0
+
+    def inc(self, n=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def increment(self):
+        pass
+
+
+class MetricsRegistry:
+    """
+    Small registry of counters, gauges and latency histograms.
+
+    snapshot() returns all metrics as a dict, text() in the Prometheus
+    text format and serve() publishes text() on a local HTTP endpoint.
+    log() prints a one-line summary at most once per log_interval seconds.
+    When the registry is disabled every metric is a shared NullMetric, so
+    instrumented code costs one no-op call.
+    """
+
+    def __init__(self, enabled=True, log_interval=5):
+        self.enabled = enabled
+        self.log_interval = log_interval
+        self._metrics = {}
+        self._lock = Lock()
+        self._last_log = 0
+        self._null = NullMetric()
+
+    def _get(self, kind, name, *args):
+        if not self.enabled:
+            return self._null
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, kind(name, *args))
+        return metric
+
+    def counter(self, name):
+        return self._get(Counter, name)
+
+    def gauge(self, name):
+        return self._get(Gauge, name)
+
+    def histogram(self, name, buckets=None):
+        return self._get(Histogram, name, buckets)
+
+    def _items(self):
+        # metrics are added from other threads while they are listed
+        with self._lock:
+            return sorted(self._metrics.items())
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._items()}
+
+    def text(self):
+        lines = []
+        for name, metric in self._items():
+            name = 'zoom_' + name
+            if isinstance(metric, Counter):
+                lines.append(f'# TYPE {name}_total counter')
+                lines.append(f'{name}_total {metric.value}')
+            elif isinstance(metric, Gauge):
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {metric.value}')
+            else:
+                lines.append(f'# TYPE {name}_seconds histogram')
+                total = 0
+                for bound, count in zip(metric.buckets + ('+Inf',),
+                                        metric.counts):
+                    total += count
+                    lines.append(f'{name}_seconds_bucket{{le="{bound}"}} {total}')
+                lines.append(f'{name}_seconds_sum {metric.sum}')
+                lines.append(f'{name}_seconds_count {metric.count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=8000, host='127.0.0.1'):
+        """Serve text() on http://host:port/metrics from a daemon thread."""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        Thread(target=server.serve_forever, name='MetricsServer',
+               daemon=True).start()
+        return server
+
+    def log(self):
+        if not self.enabled or time() - self._last_log < self.log_interval:
+            return
+        self._last_log = time()
+        parts = []
+        for name, metric in self._items():
+            if isinstance(metric, Counter):
+                parts.append(f'{name}: {metric.counts_per_sec():.1f}/s')
+            elif isinstance(metric, Gauge):
+                parts.append(f'{name}: {metric.value}')
+            elif metric.count:
+                parts.append(f'{name}: {metric.sum / metric.count * 1000:.1f} ms')
+        print(' | '.join(parts))
+
+
+# Registry used by the classes below. Disabled until the program enables it.
+metrics = MetricsRegistry(enabled=False)
+
+
+class StageTimer:
+    """
+    Busy and idle time of a pipeline stage thread. The stage calls
+    switch(False) before it waits and switch(True) when it has work again.
+    The share of busy time is published as the gauge <name>_busy.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0
+        self.idle = 0
+        self._busy = False
+        self._since = time()
+        self._busy_metric = metrics.gauge(f'{name}_busy')
+
+    def switch(self, busy):
+        now = time()
+        if self._busy:
+            self.busy += now - self._since
+        else:
+            self.idle += now - self._since
+        self._busy = busy
+        self._since = now
+        self._busy_metric.set(round(self.utilization(), 2))
+
+    def utilization(self):
+        total = self.busy + self.idle
+        return self.busy / total if total else 0
+
+    def snapshot(self):
+        return {'busy': self.busy, 'idle': self.idle,
+                'utilization': self.utilization()}
+
+
+def stop_thread(thread):
+    # a stage may be stopped from its own thread, e.g. on 'q'
+    if thread is not None and thread is not current_thread():
+        thread.join()
+
+
 class VideoGet:
     """
-    Class that continuously gets screenshots from named window
-    with a dedicated thread.
+    Class that continuously gets screenshots from a frame source
+    (named window, video file, image folder...) with a dedicated thread.
+    capture_time is the duration of the last capture in seconds.
+
+    With fps the screenshots are taken at that rate, else as fast as the
+    source gives them. Every new screenshot increments frames and notifies
+    new_frame (a Condition that can be shared by several VideoGet), so
+    consumers block in wait() instead of polling.
     """
 
-    def __init__(self, src):
-        self.stream = WindowCapture(src)
+    def __init__(self, src, loop=False, fps=None, new_frame=None):
+        self.stream = open_frame_source(src, loop=loop)
+        self.capture_time = 0
+        self._capture_metric = metrics.histogram('capture')
+        self.timer = StageTimer('capture')
+        self.frame_interval = 1 / fps if fps else 0
+        self.new_frame = new_frame or Condition()
+        self.frames = 0
         self.screenshot = self.stream.get_screenshot()
-        self.stopped = False
+        self.stopped = self.screenshot is None
+        self._stop_event = Event()
+        self._thread = None
 
     def start(self):
-        Thread(target=self.get, name='VideoGet', args=(), daemon=True).start()
+        self._thread = Thread(target=self.get, name='VideoGet', args=(),
+                              daemon=True)
+        self._thread.start()
         return self
 
     def get(self):
+        next_time = time()
         while not self.stopped:
-            self.screenshot = self.stream.get_screenshot()
-
+            self.timer.switch(True)
+            time_get = time()
+            screenshot = self.stream.get_screenshot()
+            self.capture_time = time() - time_get
+            self._capture_metric.observe(self.capture_time)
+            with self.new_frame:
+                if screenshot is None:
+                    # source is exhausted
+                    self.stopped = True
+                else:
+                    self.screenshot = screenshot
+                    self.frames += 1
+                self.new_frame.notify_all()
+            if screenshot is None:
+                break
+            self.timer.switch(False)
+            if self.frame_interval:
+                next_time = max(next_time + self.frame_interval, time())
+                # stop() ends the wait early
+                self._stop_event.wait(max(0, next_time - time()))
+        self.stream.release()
+
+    def wait(self, last_frame, timeout=None):
+        """
+        Wait until there is a screenshot newer than last_frame or the
+        capture stopped. Returns frames.
+        """
+        with self.new_frame:
+            self.new_frame.wait_for(
+                lambda: self.frames != last_frame or self.stopped, timeout)
+            return self.frames
 
     def stop(self):
-        self.stopped = True
+        with self.new_frame:
+            self.stopped = True
+            self.new_frame.notify_all()
+        self._stop_event.set()
+        stop_thread(self._thread)
 
 
 class VideoShow:
     """
-    Class that continuously shows a screenshots using a dedicated thread.
+    Class that shows screenshots using a dedicated thread.
+
+    update() hands over a new screenshot and wakes the thread up. Between
+    screenshots the thread only processes the window events every
+    event_interval seconds. Pressing 'q' with the window focused stops it.
     """
 
-    def __init__(self, screenshot=None):
+    def __init__(self, screenshot=None, event_interval=0.05):
         self.screenshot = screenshot
+        self.event_interval = event_interval
         self.stopped = False
+        self._display_metric = metrics.histogram('display')
+        self.timer = StageTimer('display')
+        self._condition = Condition()
+        self._new = screenshot is not None
+        self._thread = None
 
     def start(self):
-        Thread(target=self.show, name='VideoShow', args=(), daemon=True).start()
+        self._thread = Thread(target=self.show, name='VideoShow', args=(),
+                              daemon=True)
+        self._thread.start()
         return self
 
+    def update(self, screenshot):
+        with self._condition:
+            self.screenshot = screenshot
+            self._new = True
+            self._condition.notify()
+
     def show(self):
         while not self.stopped:
+            with self._condition:
+                self.timer.switch(False)
+                self._condition.wait_for(lambda: self._new or self.stopped,
+                                         self.event_interval)
+                self.timer.switch(True)
+                screenshot = self.screenshot if self._new else None
+                self._new = False
+            if screenshot is not None:
+                time_show = time()
+                cv.imshow('ZOOM Class Attendance', screenshot)
+                self._display_metric.observe(time() - time_show)
             # press 'q' with the output window focused to exit.
-            # waits 1 ms every loop to process key presses
-            cv.imshow('ZOOM Class Attendance', self.screenshot)
+            # waits 1 ms to process key presses
             if cv.waitKey(1) == ord('q'):
                 self.stopped = True
-
+        # windows belong to the thread that created them
+        cv.destroyAllWindows()
 
     def stop(self):
-        self.stopped = True
+        with self._condition:
+            self.stopped = True
+            self._condition.notify()
+        stop_thread(self._thread)
+
+
+class FrameRingBuffer:
+    """
+    Fixed-capacity ring buffer of preallocated frame slots.
+
+    All slots are allocated up front, so memory use is known when the
+    buffer is created (see nbytes). Every frame put into the buffer gets a
+    sequence number. When the buffer is full the overflow policy decides
+    what happens to a new frame:
+        'drop_oldest' - the oldest frame is overwritten,
+        'drop_newest' - the new frame is dropped,
+        'block'       - put() waits for a free slot (up to timeout).
+    """
+    policies = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, capacity, shape, dtype=np.uint8, policy='drop_oldest'):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        if policy not in self.policies:
+            raise ValueError('Unknown overflow policy: {}'.format(policy))
+        self.capacity = capacity
+        self.policy = policy
+        self.slots = np.empty((capacity,) + tuple(shape), dtype=dtype)
+        self.sequences = np.full(capacity, -1, dtype=np.int64)
+        self.dropped = 0
+        self.closed = False
+        self.interrupted = False  # see interrupt()
+        self._head = 0  # slot of the oldest frame
+        self._count = 0
+        self._next_sequence = 0
+        self._condition = Condition()
+
+    @property
+    def nbytes(self):
+        return self.slots.nbytes
+
+    def __len__(self):
+        return self._count
+
+    def put(self, frame, timeout=None):
+        """
+        Copy frame into a free slot. Returns the sequence number given to
+        the frame, or None if it was dropped, timed out or the buffer
+        is closed.
+        """
+        with self._condition:
+            if self._count == self.capacity:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return None
+                if self.policy == 'drop_oldest':
+                    self._head = (self._head + 1) % self.capacity
+                    self._count -= 1
+                    self.dropped += 1
+                elif not self._condition.wait_for(
+                        lambda: self._count < self.capacity or self.closed,
+                        timeout):
+                    return None
+            if self.closed:
+                return None
+            slot = (self._head + self._count) % self.capacity
+            np.copyto(self.slots[slot], frame)
+            sequence = self._next_sequence
+            self.sequences[slot] = sequence
+            self._next_sequence += 1
+            self._count += 1
+            self._condition.notify_all()
+            return sequence
+
+    def get(self, out=None, timeout=None):
+        """
+        Take the oldest frame out of the buffer, waiting up to timeout
+        seconds for one to arrive. The frame is copied into out (or into
+        a new array if out is None). Returns (sequence, frame), or
+        (None, None) on timeout or when the buffer is closed or interrupted
+        and empty.
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._count or self.closed or self.interrupted,
+                    timeout) or not self._count:
+                return None, None
+            slot = self._head
+            if out is None:
+                out = self.slots[slot].copy()
+            else:
+                np.copyto(out, self.slots[slot])
+            sequence = int(self.sequences[slot])
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+            self._condition.notify_all()
+            return sequence, out
+
+    def close(self):
+        # wake up every waiting put() and get()
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def interrupt(self):
+        # wake up every waiting get() and don't let get() wait any more,
+        # put() keeps working
+        with self._condition:
+            self.interrupted = True
+            self._condition.notify_all()
 
 
 class VideoQueue:
+    """
+    Class that delays processed screenshots through a bounded ring buffer
+    and pops them for display with a dedicated thread, which sleeps on the
+    buffer while it is empty. Popped screenshots are handed to
+    output.update() (a VideoShow), if output is given.
+    If fps is given, screenshots are popped at most at that rate.
+    """
 
-    def __init__(self, screenshot=None):
-        self.video_queue = deque()
-        self.screenshot = screenshot
+    def __init__(self, screenshot, capacity=100, policy='drop_oldest',
+                 fps=None, output=None):
+        self.video_queue = FrameRingBuffer(capacity, screenshot.shape,
+                                           screenshot.dtype, policy)
+        # the display reads screenshot_out while the next one is copied,
+        # so rotate between a few output buffers
+        self._out_buffers = [np.empty_like(screenshot) for _ in range(3)]
         self.screenshot_out = None
-        self.stopped_add = False
+        self.sequence_out = None
+        self._depth_metric = metrics.gauge('queue_depth')
+        self._dropped_metric = metrics.counter('queue_dropped')
+        self.timer = StageTimer('queue')
+        self.output = output
+        self.frame_interval = 1 / fps if fps else 0
         self.stopped_pop = False
         self.stopped = False
-
-    def start_add(self):
-        Thread(target=self.add, name='VideoQueueAdd', args=(), daemon=True).start()
-        # Thread(target=self.pop, name='VideoQueuePop', args=()).start()
-        return self
+        self._stop_event = Event()
+        self._thread = None
 
     def start_pop(self):
-        Thread(target=self.pop, name='VideoQueuePop', args=(), daemon=True).start()
+        self._thread = Thread(target=self.pop, name='VideoQueuePop', args=(),
+                              daemon=True)
+        self._thread.start()
         return self
 
-    def add(self):
-        while not self.stopped or not self.stopped_add:
-            self.video_queue.append(self.screenshot)
-
+    def add(self, screenshot, timeout=None):
+        sequence = self.video_queue.put(screenshot, timeout)
+        if sequence is None:
+            self._dropped_metric.inc()
+        self._depth_metric.set(len(self.video_queue))
+        return sequence
 
     def pop(self):
-        while not self.stopped or not self.stopped_pop:
-            self.screenshot_out = self.video_queue.popleft()
-
+        index = 0
+        next_time = time()
+        while not self.stopped and not self.stopped_pop:
+            self.timer.switch(False)
+            # close() and interrupt() wake the wait up
+            sequence, screenshot = self.video_queue.get(
+                self._out_buffers[index])
+            self.timer.switch(True)
+            if screenshot is None:
+                break
+            self.screenshot_out = screenshot
+            self.sequence_out = sequence
+            if self.output is not None:
+                self.output.update(screenshot)
+            index = (index + 1) % len(self._out_buffers)
+            if self.frame_interval:
+                next_time = max(next_time + self.frame_interval, time())
+                self.timer.switch(False)
+                self._stop_event.wait(max(0, next_time - time()))
 
     def size(self):
         return len(self.video_queue)
 
-    def stop_add(self):
-        self.stopped_add = True
-
     def stop_pop(self):
+        # stop the display thread only, add() keeps filling the buffer
         self.stopped_pop = True
+        self._stop_event.set()
+        self.video_queue.interrupt()
+        stop_thread(self._thread)
 
     def stop(self):
         self.stopped = True
+        self._stop_event.set()
+        self.video_queue.close()
+        stop_thread(self._thread)
+
+
+class VideoWrite:
+    """
+    Class that encodes annotated screenshots into a video file with a
+    dedicated thread, so the program can run without a display.
+
+    write() only copies the screenshot into a bounded ring buffer (see
+    FrameRingBuffer for the overflow policies), the encoder thread takes
+    them out and writes them with cv.VideoWriter. stop() writes the
+    screenshots still in the buffer before closing the file.
+    """
+
+    def __init__(self, file_path, screenshot, fps=25, fourcc='mp4v',
+                 capacity=30, policy='drop_oldest'):
+        height, width = screenshot.shape[:2]
+        self.file_path = file_path
+        self.writer = cv.VideoWriter(file_path, cv.VideoWriter_fourcc(*fourcc),
+                                     fps, (width, height))
+        if not self.writer.isOpened():
+            raise Exception('Video file cannot be written: {}'.format(file_path))
+        self.video_queue = FrameRingBuffer(capacity, screenshot.shape,
+                                           screenshot.dtype, policy)
+        self._out_buffer = np.empty_like(screenshot)
+        self._write_metric = metrics.histogram('write')
+        self._dropped_metric = metrics.counter('write_dropped')
+        self.timer = StageTimer('write')
+        self.frames = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self.encode, name='VideoWrite', args=(),
+                              daemon=True)
+        self._thread.start()
+        return self
+
+    def write(self, screenshot, timeout=None):
+        sequence = self.video_queue.put(screenshot, timeout)
+        if sequence is None:
+            self._dropped_metric.inc()
+        return sequence
+
+    def encode(self):
+        while True:
+            self.timer.switch(False)
+            # returns (None, None) once the buffer is closed and empty
+            sequence, screenshot = self.video_queue.get(self._out_buffer)
+            self.timer.switch(True)
+            if screenshot is None:
+                break
+            time_write = time()
+            self.writer.write(screenshot)
+            self._write_metric.observe(time() - time_write)
+            self.frames += 1
+        self.writer.release()
+
+    def stop(self):
+        self.video_queue.close()
+        if self._thread is not None:
+            stop_thread(self._thread)
+        else:
+            self.writer.release()
 
 
 # class ScreenshotFaceRecognition:
@@ -0,0 +1,215 @@
+import os
+
+import numpy as np
+
+INDEX_FILE = 'face_index.npz'
+
+
+def _squared_distances(data, centroids, centroid_norms=None):
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, as one matrix product
+    if centroid_norms is None:
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    distances = data @ centroids.T
+    distances *= -2
+    distances += np.einsum('ij,ij->i', data, data)[:, None]
+    distances += centroid_norms[None, :]
+    return distances
+
+
+def _nearest(data, centroids, chunk_size=65536):
+    # index of the nearest centroid for every row of data, in chunks so the
+    # distance matrix stays small for big galleries
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        labels[start:start + chunk_size] = np.argmin(
+            _squared_distances(chunk, centroids, centroid_norms), axis=1)
+    return labels
+
+
+def _kmeans(data, k, n_iter, rng):
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _nearest(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        # sum the members of every cluster with one sort and reduceat
+        order = np.argsort(labels, kind='stable')
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        centroids[filled] = np.add.reduceat(data[order], starts, axis=0) \
+            / counts[filled, None]
+        # move empty clusters to random points
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty),
+                                               replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Approximate nearest neighbour index for big galleries of face encodings,
+    in pure NumPy.
+
+    The gallery is split into n_lists clusters (inverted file, IVF). A query
+    is only compared with the members of the n_probe clusters with the
+    nearest centroids, so the query time grows with about
+    n_probe * N / n_lists instead of N. With pq_subvectors > 0 the members
+    are first ranked by product-quantized (PQ) codes and only the best
+    rerank candidates get exact distances; without PQ all members of the
+    probed clusters get exact distances. Exact distances come from the
+    gallery encodings, so the returned distances are the same as the
+    brute-force ones.
+
+    Knobs: more n_probe and rerank give better recall and slower queries.
+    """
+
+    def __init__(self, n_lists=None, pq_subvectors=0, n_probe=8, rerank=64):
+        self.n_lists = n_lists
+        self.pq_subvectors = pq_subvectors
+        self.n_probe = n_probe
+        self.rerank = rerank
+        self.encodings = None
+        self.centroids = None
+        self.list_offsets = None
+        self.list_ids = None
+        self.pq_codebooks = None
+        self.pq_codes = None
+
+    def __len__(self):
+        return 0 if self.list_ids is None else len(self.list_ids)
+
+    def build(self, encodings, n_iter=20, sample_size=100000, seed=0):
+        """
+        Cluster the gallery encodings. k-means is trained on at most
+        sample_size encodings, then every encoding is assigned to a list.
+        """
+        self.encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+        size = len(self.encodings)
+        if not self.n_lists:
+            self.n_lists = max(1, int(4 * np.sqrt(size)))
+        self.n_lists = min(self.n_lists, size)
+        rng = np.random.default_rng(seed)
+        sample = self.encodings
+        if size > sample_size:
+            sample = sample[rng.choice(size, sample_size, replace=False)]
+        self.centroids = _kmeans(sample, self.n_lists, n_iter, rng)
+        labels = _nearest(self.encodings, self.centroids)
+        self.list_ids = np.argsort(labels, kind='stable').astype(np.int32)
+        self.list_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(labels, minlength=self.n_lists))))
+
+        if self.pq_subvectors:
+            dim = self.encodings.shape[1]
+            if dim % self.pq_subvectors:
+                raise ValueError('pq_subvectors must divide the encoding '
+                                 'size {}'.format(dim))
+            sub_dim = dim // self.pq_subvectors
+            ksub = min(256, len(sample))
+            self.pq_codebooks = np.empty((self.pq_subvectors, ksub, sub_dim),
+                                         dtype=np.float32)
+            codes = np.empty((size, self.pq_subvectors), dtype=np.uint8)
+            for m in range(self.pq_subvectors):
+                part = slice(m * sub_dim, (m + 1) * sub_dim)
+                self.pq_codebooks[m] = _kmeans(
+                    np.ascontiguousarray(sample[:, part]), ksub, n_iter, rng)
+                codes[:, m] = _nearest(
+                    np.ascontiguousarray(self.encodings[:, part]),
+                    self.pq_codebooks[m])
+            # keep the codes in list order so a list is one contiguous slice
+            self.pq_codes = codes[self.list_ids]
+        return self
+
+    def search(self, queries, k=1, n_probe=None, rerank=None):
+        """
+        Return (indices, distances), both (Q x k), of the k nearest gallery
+        encodings for every query, nearest first. Rows are padded with -1
+        and inf if the probed lists hold less than k encodings.
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        rerank = max(rerank or self.rerank, k)
+        queries = np.asarray(queries, dtype=np.float32).reshape(
+            -1, self.centroids.shape[1])
+        indices = np.full((len(queries), k), -1, dtype=np.intp)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        coarse = _squared_distances(queries, self.centroids)
+        if n_probe < self.n_lists:
+            probes = np.argpartition(coarse, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.broadcast_to(np.arange(self.n_lists), coarse.shape)
+        for row, query in enumerate(queries):
+            slices = [slice(self.list_offsets[probe],
+                            self.list_offsets[probe + 1])
+                      for probe in probes[row]]
+            candidates = np.concatenate([self.list_ids[s] for s in slices])
+            if not len(candidates):
+                continue
+            if self.pq_codes is not None and len(candidates) > rerank:
+                codes = np.concatenate([self.pq_codes[s] for s in slices])
+                approximate = self._pq_distances(query, codes)
+                shortlist = np.argpartition(approximate, rerank - 1)[:rerank]
+                candidates = candidates[shortlist]
+            # exact rerank of the shortlist
+            exact = self.encodings[candidates] - query
+            exact = np.sqrt(np.einsum('ij,ij->i', exact, exact))
+            count = min(k, len(candidates))
+            best = np.argpartition(exact, count - 1)[:count] \
+                if count < len(candidates) else np.arange(count)
+            best = best[np.argsort(exact[best])]
+            indices[row, :count] = candidates[best]
+            distances[row, :count] = exact[best]
+        return indices, distances
+
+    def _pq_distances(self, query, codes):
+        # asymmetric distances: one table of subvector distances per query,
+        # then a lookup and sum per candidate
+        sub_dim = self.pq_codebooks.shape[2]
+        parts = query.reshape(self.pq_subvectors, 1, sub_dim)
+        tables = ((self.pq_codebooks - parts) ** 2).sum(axis=2)
+        return tables[np.arange(self.pq_subvectors), codes].sum(axis=1)
+
+    def save(self, path):
+        """Save the index next to the gallery files in folder path."""
+        arrays = dict(centroids=self.centroids,
+                      list_offsets=self.list_offsets,
+                      list_ids=self.list_ids,
+                      settings=np.array([self.n_lists, self.pq_subvectors,
+                                         self.n_probe, self.rerank]))
+        if self.pq_codes is not None:
+            arrays.update(pq_codebooks=self.pq_codebooks,
+                          pq_codes=self.pq_codes)
+        np.savez(os.path.join(path, INDEX_FILE), **arrays)
+
+    @classmethod
+    def load(cls, path, encodings):
+        """
+        Load the index of folder path. encodings are the gallery encodings
+        the index was built for, they are used for the exact rerank.
+        """
+        data = np.load(os.path.join(path, INDEX_FILE))
+        n_lists, pq_subvectors, n_probe, rerank = (int(x) for x in
+                                                   data['settings'])
+        index = cls(n_lists, pq_subvectors, n_probe, rerank)
+        index.encodings = np.ascontiguousarray(encodings, dtype=np.float32)
+        index.centroids = data['centroids']
+        index.list_offsets = data['list_offsets']
+        index.list_ids = data['list_ids']
+        if pq_subvectors:
+            index.pq_codebooks = data['pq_codebooks']
+            index.pq_codes = data['pq_codes']
+        if len(index) != len(index.encodings):
+            raise ValueError('Index in {} doesn\'t match the gallery, run '
+                             'setup_class again'.format(path))
+        return index
+
+
+def load_face_index(path, encodings):
+    """Return the index of folder path, or None if there is no usable one."""
+    if not os.path.isfile(os.path.join(path, INDEX_FILE)):
+        return None
+    try:
+        return IVFIndex.load(path, encodings)
+    except ValueError as exc:
+        print(f'WARNING: {exc}')
+        return None
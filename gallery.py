@@ -0,0 +1,250 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+GALLERY_FILE = 'gallery.bin'
+GALLERY_MAGIC = b'FGAL'
+GALLERY_VERSION = 2
+
+# magic, version, count, dim, dtype code, then offset (and size) of the
+# embeddings, squared norms, name offsets, names and metadata sections
+_HEADER = struct.Struct('<4sIQII7Q')
+# version 2: sample count, then offset of the sample encodings, their
+# squared norms, the per-identity sample offsets and the spreads
+_SAMPLES_HEADER = struct.Struct('<5Q')
+_ALIGNMENT = 4096  # sections start on page boundaries for np.memmap
+_DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<f2')}
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class GalleryNames:
+    """
+    Read-only sequence of the names of a gallery. Names are decoded from
+    the UTF-8 name table on access, so opening a gallery doesn't decode
+    millions of them.
+    """
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return bytes(self._blob[start:end]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class Gallery:
+    """
+    Known faces of a class opened from gallery.bin.
+
+    encodings and norms (squared norms of the encodings) are np.memmap
+    views of the file, so opening is near-instant and processes opening the
+    same gallery share the pages. metadata is a list of per-identity dicts,
+    parsed on first access.
+
+    Classes enrolled with several images per person also have samples:
+    then encodings are the per-identity centroids, the sample encodings of
+    identity i are samples[sample_offsets[i]:sample_offsets[i + 1]] and
+    spreads[i] is the largest distance of a sample to its centroid.
+    Otherwise samples is None.
+    """
+
+    def __init__(self, file_path, names, encodings, norms, metadata_bytes,
+                 version, samples=None, sample_norms=None,
+                 sample_offsets=None, spreads=None):
+        self.file_path = file_path
+        self.names = names
+        self.encodings = encodings
+        self.norms = norms
+        self.samples = samples
+        self.sample_norms = sample_norms
+        self.sample_offsets = sample_offsets
+        self.spreads = spreads
+        self.version = version
+        self._metadata_bytes = metadata_bytes
+        self._metadata = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = json.loads(bytes(self._metadata_bytes) or b'[]')
+        return self._metadata
+
+
+def _stored(encodings, dtype):
+    # encodings as they are stored and their norms, computed from the
+    # stored values so float16 galleries give consistent distances
+    stored = encodings.astype(dtype)
+    rounded = stored.astype(np.float32)
+    return stored, np.einsum('ij,ij->i', rounded, rounded).astype('<f4')
+
+
+def write_gallery(path, names, encodings, metadata=None, dtype=np.float32,
+                  samples=None, sample_offsets=None, spreads=None):
+    """
+    Write the gallery file of class folder path. dtype is np.float32 or
+    np.float16 (half the size, slightly less precise distances).
+    With samples (see Gallery) encodings are the identity centroids.
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    dtype_code = {v: k for k, v in _DTYPES.items()}[dtype]
+    encodings = np.asarray(encodings, dtype=np.float32)
+    # an empty gallery still has 128-d encodings
+    encodings = encodings.reshape(len(names), -1) if len(names) \
+        else encodings.reshape(0, 128)
+    dim = encodings.shape[1]
+    stored, norms = _stored(encodings, dtype)
+    if samples is not None:
+        samples, sample_norms = _stored(
+            np.asarray(samples, dtype=np.float32).reshape(-1, dim), dtype)
+        sample_offsets = np.asarray(sample_offsets, dtype='<u8')
+        spreads = np.asarray(spreads, dtype='<f4')
+        if len(sample_offsets) != len(names) + 1 \
+                or sample_offsets[-1] != len(samples) \
+                or len(spreads) != len(names):
+            raise ValueError('Samples don\'t fit the identities')
+    else:
+        samples = np.empty((0, dim), dtype=dtype)
+        sample_norms = np.empty(0, dtype='<f4')
+        sample_offsets = np.empty(0, dtype='<u8')
+        spreads = np.empty(0, dtype='<f4')
+    encoded_names = [str(name).encode('utf-8') for name in names]
+    name_offsets = np.zeros(len(names) + 1, dtype='<u8')
+    np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+    metadata_bytes = json.dumps(metadata or []).encode('utf-8')
+
+    embeddings_offset = _align(_HEADER.size + _SAMPLES_HEADER.size)
+    norms_offset = _align(embeddings_offset + len(names) * dim * dtype.itemsize)
+    samples_offset = _align(norms_offset + norms.nbytes)
+    sample_norms_offset = _align(samples_offset + samples.nbytes)
+    sample_offsets_offset = _align(sample_norms_offset + sample_norms.nbytes)
+    spreads_offset = _align(sample_offsets_offset + sample_offsets.nbytes)
+    name_offsets_offset = _align(spreads_offset + spreads.nbytes)
+    names_offset = name_offsets_offset + name_offsets.nbytes
+    names_size = int(name_offsets[-1])
+    metadata_offset = names_offset + names_size
+    header = _HEADER.pack(GALLERY_MAGIC, GALLERY_VERSION, len(names), dim,
+                          dtype_code, embeddings_offset, norms_offset,
+                          name_offsets_offset, names_offset, names_size,
+                          metadata_offset, len(metadata_bytes)) \
+        + _SAMPLES_HEADER.pack(len(samples), samples_offset,
+                               sample_norms_offset, sample_offsets_offset,
+                               spreads_offset)
+
+    file_path = os.path.join(path, GALLERY_FILE)
+    temp_file_path = file_path + '.tmp'
+    with open(temp_file_path, 'wb') as file:
+        file.write(header)
+        file.seek(embeddings_offset)
+        file.write(stored.tobytes())
+        file.seek(norms_offset)
+        file.write(norms.tobytes())
+        for offset, section in ((samples_offset, samples),
+                                (sample_norms_offset, sample_norms),
+                                (sample_offsets_offset, sample_offsets),
+                                (spreads_offset, spreads)):
+            file.seek(offset)
+            file.write(section.tobytes())
+        file.seek(name_offsets_offset)
+        file.write(name_offsets.tobytes())
+        file.write(b''.join(encoded_names))
+        file.write(metadata_bytes)
+    # readers never see a half written gallery
+    os.replace(temp_file_path, file_path)
+
+
+def open_gallery(path):
+    """Open the gallery file of class folder path without reading it."""
+    file_path = os.path.join(path, GALLERY_FILE)
+    with open(file_path, 'rb') as file:
+        header = file.read(_HEADER.size + _SAMPLES_HEADER.size)
+    if len(header) < _HEADER.size:
+        raise ValueError('Gallery file is truncated: {}'.format(file_path))
+    (magic, version, count, dim, dtype_code, embeddings_offset, norms_offset,
+     name_offsets_offset, names_offset, names_size, metadata_offset,
+     metadata_size) = _HEADER.unpack(header[:_HEADER.size])
+    if magic != GALLERY_MAGIC:
+        raise ValueError('Not a gallery file: {}'.format(file_path))
+    if version > GALLERY_VERSION:
+        raise ValueError('Gallery file version {} is newer than supported '
+                         '({})'.format(version, GALLERY_VERSION))
+    # the whole file is mapped once, sections are views of it
+    data = np.memmap(file_path, dtype=np.uint8, mode='r')
+    dtype = _DTYPES[dtype_code]
+    encodings = data[embeddings_offset:
+                     embeddings_offset + count * dim * dtype.itemsize] \
+        .view(dtype).reshape(count, dim)
+    norms = data[norms_offset:norms_offset + count * 4].view('<f4')
+    name_offsets = data[name_offsets_offset:
+                        name_offsets_offset + (count + 1) * 8].view('<u8')
+    names = GalleryNames(name_offsets,
+                         data[names_offset:names_offset + names_size])
+    metadata = data[metadata_offset:metadata_offset + metadata_size]
+    sections = {}
+    if version >= 2:
+        (sample_count, samples_offset, sample_norms_offset,
+         sample_offsets_offset, spreads_offset) = _SAMPLES_HEADER.unpack(
+            header[_HEADER.size:])
+        if sample_count:
+            sections['samples'] = data[
+                samples_offset:
+                samples_offset + sample_count * dim * dtype.itemsize] \
+                .view(dtype).reshape(sample_count, dim)
+            sections['sample_norms'] = data[
+                sample_norms_offset:
+                sample_norms_offset + sample_count * 4].view('<f4')
+            sections['sample_offsets'] = data[
+                sample_offsets_offset:
+                sample_offsets_offset + (count + 1) * 8].view('<u8')
+            sections['spreads'] = data[spreads_offset:
+                                       spreads_offset + count * 4].view('<f4')
+    return Gallery(file_path, names, encodings, norms, metadata, version,
+                   **sections)
+
+
+def load_gallery(path):
+    """
+    Return (names, encodings, norms) of class folder path: from gallery.bin
+    if there is one, else from the older names.npy and face_encodings.npy
+    (norms is None then).
+    """
+    if os.path.isfile(os.path.join(path, GALLERY_FILE)):
+        gallery = open_gallery(path)
+        return gallery.names, gallery.encodings, gallery.norms
+    names = np.load(f'{path}/names.npy')
+    encodings = np.load(f'{path}/face_encodings.npy')
+    return list(names), encodings, None
+
+
+def load_samples(path):
+    """
+    Return the sample sections of the gallery of class folder path as
+    FaceMatcher keyword arguments, {} if the class has one image per
+    person.
+    """
+    if not os.path.isfile(os.path.join(path, GALLERY_FILE)):
+        return {}
+    gallery = open_gallery(path)
+    if gallery.samples is None:
+        return {}
+    return {'samples': gallery.samples, 'sample_norms': gallery.sample_norms,
+            'sample_offsets': gallery.sample_offsets,
+            'spreads': gallery.spreads}
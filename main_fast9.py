@@ -1,189 +1,188 @@
-import threading
-
+from attendance import AttendanceLog
+from changes import ChangeDetector
 from classes import *
-
-
-def face_recognition(frm):
-    global resize
-    global buffering_flag
-    global frame_count
-    global known_face_encodings
-    global known_face_names
-    global face_locations
-    global face_names
-    if resize != 1:
-        stored_frame = frm
-        frame = cv.resize(frm, (0, 0), fx=1 / resize,
-                          fy=1 / resize)
-        # Convert the image from BGR color (which OpenCV uses) to RGB color
-        # (which face_recognition uses)
-        frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
-    else:
-        stored_frame = frm
-        frame = frm
-
-    if not buffering_flag:
-        print('frame_count:', frame_count)
-    if frame_count == 1:
-
-        # Find all the faces and face encodings in the screenshot
-        time_fr = time()
-        face_locations = fr.face_locations(frame)
-        if not buffering_flag:
-            print('face_location time:', time() - time_fr)
-        time_fr = time()
-        face_encodings = fr.face_encodings(frame, face_locations)
-        if not buffering_flag:
-            print('face_encodings time:', time() - time_fr)
-        # Loop through each face in this frame of video
-        face_names = []
-        if not buffering_flag:
-            print('count_face_encodings:', len(face_encodings))
-        for face_encoding in face_encodings:
-            # See if the face is a match for the known faces
-            matches = fr.compare_faces(known_face_encodings, face_encoding)
-
-            name = "Unknown"
-
-            # Use the known face with the smallest distance to the new face
-            face_distances = fr.face_distance(known_face_encodings,
-                                              face_encoding)
-            best_match_index = np.argmin(face_distances)
-            if matches[best_match_index]:
-                name = known_face_names[best_match_index]
-            face_names.append(name)
-
-    for (top, right, bottom, left), name in zip(face_locations, face_names):
-        # Scale back up face locations since
-        # the frame we detected in was scaled
-        if resize != 1:
-            top *= resize
-            right *= resize
-            bottom *= resize
-            left *= resize
-        # Draw a box around the face
-        name_len = len(name)
-        frame_width = right - left
-        name_plate_width = name_len * 10  # 10 is width of one letter approximately.
-        if frame_width < name_plate_width:
-            d_left = int((name_plate_width - frame_width) / 2)
-        else:
-            d_left = 1
-        stored_frame = cv.rectangle(stored_frame, (left, top), (right, bottom),
-                             (255, 0, 255),
-                             2)
-
-        # Draw a label with a name below the face
-        cv.rectangle(stored_frame, (left - d_left, bottom),
-                     (right + d_left, bottom + 35),
-                     (255, 0, 255), cv.FILLED)
-        cv.putText(stored_frame, name, (left - d_left + 5, bottom + 20),
-                   cv.FONT_HERSHEY_COMPLEX, 0.5, (255, 255, 255), 1)
-
-    return stored_frame
+from quality import FaceQuality
+from recognition import FaceRecognizer, RecognitionWorker, draw_faces
+from registry import load_matcher
+from scheduler import LatencyScheduler
+from shared_frames import ProcessRecognitionWorker
+from tiles import GalleryTiles
+from unknowns import UnknownFaces
+
+
+def face_recognition(frm, sequence, recognition_worker, draw=True):
+    # Hand the screenshot to the recognition worker and draw the latest
+    # results it has, never waiting for it
+    recognition_worker.submit(frm, sequence)
+    face_sequence, face_locations, face_names = recognition_worker.result
+    metrics.gauge('result_age').set(sequence - face_sequence)
+    if not draw:
+        # nobody looks at the screenshot, only the attendance is needed
+        return frm
+    time_draw = time()
+    frm = draw_faces(frm, face_locations, face_names)
+    metrics.histogram('draw').observe(time() - time_draw)
+    return frm
 
 
 ##################### PATHES #####################
 
 path = 'class_trofim'
 
-##################### Read recognition data #####################
-start_time = time()
-known_face_names = np.load(
-    f'{path}/names.npy')  # LIST CONTAINING ALL THE CORRESPONDING CLASS Names
-known_face_encodings = np.load(
-    f'{path}/face_encodings.npy')  # LIST CONTAINING ALL THE CORRESPONDING KNOWN FACE
-print('Recognition data received', time() - start_time, 'sec')
-
 ########## Settings ##########
+# Window name, video file, image folder, camera index or 'synthetic'
+source = 'Video conference at ZOOM.mp4'
+capture_fps = None  # How many screenshots per sec are taken. None - as fast as the source gives them
 resize = 2  # Must be integer more than "0". Shows how many times the image should be reduced
 frame_rate = 100  # Which screenshot will be processed by facial recognition
-frame_count = 1
-buffer_size = 1000000  # How many screenshots will be written to the buffer before it starts displaying
+buffer_size = 100  # How many screenshots will be written to the buffer before it starts displaying
+buffer_policy = 'drop_oldest'  # What to do when the buffer is full: 'drop_oldest', 'drop_newest' or 'block'
 stack_size = 0
+tolerance = 0.6  # How much distance between faces to consider it a match. Lower is more strict
+latency_budget = None  # Max age of detection results in sec (e.g. 0.5). If set, resize and frame_rate are adjusted at runtime
+display_fps = 30  # Display rate the latency budget is planned for
+gallery_tiles = False  # If True faces are detected tile by tile on ZOOM gallery view (in parallel)
+metrics_enabled = True  # Collect per-stage metrics (capture, queue, detect, encode, match, draw, display)
+metrics_port = None  # If set, metrics are served on http://127.0.0.1:<port>/metrics
+log_interval = 5  # How often (sec) a metrics summary is printed
+attendance_interval = 60  # How often (sec) attendance.xlsx is updated from the recognition events
+unknown_clusters = 1000  # How many clusters of unknown faces are kept (0 - unknown faces aren't clustered)
+quality_gate = False  # If True only big, sharp, frontal and well lit faces are encoded (see quality.py for the thresholds)
+change_detection = False  # If True the detection only runs on the regions of the screenshot that changed
+export_unknowns = False  # If True unknown faces seen at least 3 times are saved into the "unknown" subfolder of the class folder at exit for setup_class.py
+output = 'window'  # 'window' - show the video, a file name (e.g. 'output.mp4') - write it without a display, None - no drawing, attendance only
+output_fps = 25  # Frame rate of the written video file
+recognition_processes = 0  # 0 - recognition thread in this process, N - N recognition processes that read the screenshots from shared memory (every screenshot is detected, the recognizer settings above aren't used)
 ########## Settings ##########
 
-##################### Initialize #####################
-
-
-buffering_flag = True  # If True buffering is going on. False - Buffering is stoped
-face_locations = np.ndarray
-face_names = []
-##################### Initialize #####################
-
-# initialize the Video Stream
-video_getter = VideoGet('Video conference at ZOOM.mp4').start()
-video_shower = VideoShow(video_getter.screenshot)
-cps = CountsPerSec().start()
-stack = VideoQueue(video_getter.screenshot).start_add()
-
-begin_time = time()
-
-while True:
-    if video_getter.stopped or video_shower.stopped or stack.stopped:
-        video_shower.stop()
-        video_getter.stop()
-        stack.stop()
-        cv.destroyAllWindows()
-        print('Video stream canceled!')
-        break
-    # Get an updated screenshot
-    screenshot = video_getter.screenshot
-
-    screenshot = face_recognition(screenshot)
-
-    # Put screenshots into Queue
-    stack.screenshot = screenshot
-    stack_size = stack.size()
-    print('stack_size:', stack_size)
-
-    # Display the results
-
-    #  Buffering
-    if stack_size >= buffer_size and buffering_flag is True:
-        stack.start_pop()
-        video_shower.start()
-        buffering_flag = False
-    else:
-        print(f'Buffering... ({stack_size})')
-        # print('\r', end='')
-
-
-    # Display the resulting image
 
-    video_shower.screenshot = stack.screenshot_out
-
-    cps_ = cps.counts_per_sec()
-    print(f'CPS: {cps_}')
-    cps.increment()
-    # debug the loop rate
-    loop_time = time() - begin_time
-    if loop_time == 0:
-        fps_ = 0
+def main():
+    # the worker processes (recognition_processes, gallery_tiles) import
+    # this module again when they are spawned, so nothing may run on import
+    ##################### Read recognition data #####################
+    start_time = time()
+    # gallery.bin is memory-mapped, older classes are read from the npy-files
+    matcher = load_matcher(path, tolerance)
+    known_face_names = matcher.known_face_names
+    print('Recognition data received', time() - start_time, 'sec')
+
+    ##################### Initialize #####################
+    buffering_flag = True  # If True buffering is going on. False - Buffering is stoped
+    metrics.enabled = metrics_enabled
+    metrics.log_interval = log_interval
+    if metrics_port:
+        metrics.serve(metrics_port)
+    frames_metric = metrics.counter('frames')
+    attendance = AttendanceLog(path, known_face_names,
+                               xlsx_interval=attendance_interval).start()
+    recognizer = FaceRecognizer(matcher, resize, frame_rate,
+                                tiles=GalleryTiles() if gallery_tiles else None,
+                                scheduler=LatencyScheduler(
+                                    latency_budget, display_fps, resize,
+                                    frame_rate) if latency_budget else None,
+                                attendance=attendance,
+                                unknowns=UnknownFaces(unknown_clusters)
+                                if unknown_clusters else None,
+                                quality=FaceQuality() if quality_gate else None,
+                                changes=ChangeDetector() if change_detection
+                                else None)
+    ##################### Initialize #####################
+
+    # initialize the Video Stream
+    video_getter = VideoGet(source, fps=capture_fps).start()
+    video_shower = None
+    video_writer = None
+    stack = None
+    if output == 'window':
+        video_shower = VideoShow(video_getter.screenshot)
+        stack = VideoQueue(video_getter.screenshot, capacity=buffer_size,
+                           policy=buffer_policy, output=video_shower)
+        print(f'Screenshot buffer: {stack.video_queue.nbytes / 2 ** 20:.1f} MB')
+    elif output:
+        # headless: annotated screenshots are encoded in the background
+        video_writer = VideoWrite(output, video_getter.screenshot,
+                                  fps=output_fps).start()
+        print(f'Writing annotated video into file {output}')
     else:
-        fps_ = 1 / loop_time
-    print(f'FPS: {fps_}')
-    begin_time = time()
-
-
-
-    if frame_count == frame_rate:
-        frame_count = 1
+        print('Headless mode without video output')
+    work_screenshot = np.empty_like(video_getter.screenshot)
+    if recognition_processes:
+        recognition_worker = ProcessRecognitionWorker(
+            video_getter.screenshot, path, recognition_processes, resize=resize,
+            tolerance=tolerance, attendance=attendance).start()
+        print(f'{recognition_processes} recognition processes, '
+              f'{recognition_worker.pool.slots} shared screenshot slots')
     else:
-        frame_count += 1
-
-    # press 'q' with the output window focused to exit.
-    # waits 1 ms every loop to process key presses
-    if cv.waitKey(1) == ord('q'):
-        video_getter.stop()
-        video_shower.stop()
+        recognition_worker = RecognitionWorker(recognizer,
+                                               video_getter.screenshot).start()
+    last_frame = -1
+
+    while True:
+        if video_getter.stopped or (video_shower and video_shower.stopped) \
+                or (stack and stack.stopped):
+            print('Video stream canceled!')
+            break
+        # Wait for a new screenshot (or a stopped capture)
+        frames = video_getter.wait(last_frame, timeout=0.5)
+        if frames == last_frame:
+            continue
+        last_frame = frames
+        # Get an updated screenshot. The frame source reuses its buffers, so
+        # work on a copy that the capture thread can't overwrite. The queue
+        # copies it into its own slot, so one work buffer is enough.
+        np.copyto(work_screenshot, video_getter.screenshot)
+        screenshot = work_screenshot
+
+        screenshot = face_recognition(screenshot, last_frame,
+                                      recognition_worker, draw=bool(output))
+        frames_metric.inc()
+        metrics.log()
+
+        if video_writer is not None:
+            video_writer.write(screenshot)
+            continue
+        if stack is None:
+            continue
+
+        # Put screenshots into Queue
+        stack.add(screenshot)
+        stack_size = stack.size()
+
+        # Display the results
+
+        #  Buffering
+        if stack_size >= buffer_size and buffering_flag is True:
+            stack.start_pop()
+            video_shower.start()
+            buffering_flag = False
+            print('Buffering done.')
+        # The display thread shows the popped screenshots and stops on 'q'
+
+    # Stop the stages in pipeline order, every stop() waits for its thread
+    video_getter.stop()
+    recognition_worker.stop()
+    if video_shower is not None:
         stack.stop()
-        cv.destroyAllWindows()
-        break
-
-    print(f'There are : {threading.active_count()} threads')
-    for thread in threading.enumerate():
-        print(f'Thread name: {thread.getName()}')
-    print(f'Now active thread: {threading.current_thread()}')
-
-print('Done.')
+        video_shower.stop()
+    if video_writer is not None:
+        # encode the screenshots still in the queue
+        video_writer.stop()
+        print(f'{video_writer.frames} screenshots written into file {output}')
+    for stage in (video_getter, recognition_worker, stack, video_shower,
+                  video_writer):
+        if stage is not None:
+            timer = stage.timer
+            print(f'{timer.name}: busy {timer.busy:.1f} sec, '
+                  f'idle {timer.idle:.1f} sec ({timer.utilization():.0%} busy)')
+    # Write the last events and the attendance of this session
+    attendance.stop()
+    if export_unknowns and recognizer.unknowns is not None:
+        images = recognizer.unknowns.export(path)
+        print(f'{len(images)} unknown faces saved into folder {path}/unknown. '
+              f'Rename them to the names of the persons, move them into folder '
+              f'{path} and run setup_class.py')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
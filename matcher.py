@@ -0,0 +1,174 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Result of matching one face against the known faces.
+# name and index belong to the closest known face (name is 'Unknown' if it
+# is farther than the tolerance). top_indices/top_distances hold the
+# top_k closest known faces, closest first.
+FaceMatch = namedtuple('FaceMatch', ['name', 'index', 'distance', 'is_match',
+                                     'top_indices', 'top_distances'])
+
+
+class FaceMatcher:
+    """
+    Class that matches all face encodings of a frame against the known
+    faces at once.
+
+    The known encodings are kept as one float32 matrix with precomputed
+    squared norms, so the euclidean distances of F faces to N known faces
+    come from a single (F x 128) @ (128 x N) matrix product:
+        |a - b|^2 = |a|^2 + |b|^2 - 2 a.b
+    Distances and the tolerance are the same as in fr.face_distance and
+    fr.compare_faces.
+
+    For big galleries an IVFIndex (see face_index.py) can be given; then
+    only the index shortlist is compared exactly instead of every known
+    face.
+
+    With several samples per identity (see gallery.Gallery) the known
+    encodings are the identity centroids and matching has two stages:
+    identities are ranked by the lower bound of their sample distances
+    (centroid distance minus spread), then only the best rerank
+    identities are compared with their samples and the distance of an
+    identity is the one of its closest sample. The cost grows with the
+    number of identities, not of images.
+    """
+    unknown_name = 'Unknown'
+
+    def __init__(self, known_face_encodings, known_face_names, tolerance=0.6,
+                 top_k=1, index=None, known_norms=None, samples=None,
+                 sample_norms=None, sample_offsets=None, spreads=None,
+                 rerank=5):
+        # a float32 memmap of a gallery file is used as is, without a copy
+        known_face_encodings = np.asarray(known_face_encodings,
+                                          dtype=np.float32)
+        if not known_face_encodings.size:
+            # empty gallery, face_recognition encodings are 128-d
+            known_face_encodings = known_face_encodings.reshape(0, 128)
+        self.known_face_encodings = np.ascontiguousarray(known_face_encodings)
+        if not hasattr(known_face_names, '__getitem__'):
+            known_face_names = list(known_face_names)
+        self.known_face_names = known_face_names
+        self.tolerance = tolerance
+        self.top_k = top_k
+        self.index = index
+        if known_norms is None:
+            known_norms = np.einsum('ij,ij->i', self.known_face_encodings,
+                                    self.known_face_encodings)
+        self._known_norms = known_norms
+        self.rerank = rerank
+        self.samples = None
+        if samples is not None:
+            self.samples = np.ascontiguousarray(samples, dtype=np.float32)
+            if sample_norms is None:
+                sample_norms = np.einsum('ij,ij->i', self.samples,
+                                         self.samples)
+            self._sample_norms = sample_norms
+            self.sample_offsets = np.asarray(sample_offsets, dtype=np.int64)
+            self.spreads = np.asarray(spreads, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.known_face_names)
+
+    def face_distances(self, face_encodings):
+        """
+        Return the (F x N) matrix of distances between F face encodings and
+        the N known faces.
+        """
+        faces = np.asarray(face_encodings, dtype=np.float32).reshape(
+            -1, self.known_face_encodings.shape[1])
+        face_norms = np.einsum('ij,ij->i', faces, faces)
+        distances = faces @ self.known_face_encodings.T
+        distances *= -2
+        distances += face_norms[:, None]
+        distances += self._known_norms[None, :]
+        # rounding can make distances of identical faces slightly negative
+        np.maximum(distances, 0, out=distances)
+        return np.sqrt(distances, out=distances)
+
+    def match(self, face_encodings, top_k=None):
+        """
+        Match every face encoding of a frame. Returns a list of FaceMatch,
+        one per face, in the order of face_encodings.
+        """
+        top_k = min(top_k or self.top_k, len(self))
+        if not len(face_encodings) or not top_k:
+            return [FaceMatch(self.unknown_name, -1, np.inf, False,
+                              np.empty(0, dtype=np.intp),
+                              np.empty(0, dtype=np.float32))
+                    for _ in range(len(face_encodings))]
+        if self.samples is not None:
+            return self._match_samples(face_encodings, top_k)
+        if self.index is not None:
+            return self._results(*self.index.search(face_encodings, top_k))
+        distances = self.face_distances(face_encodings)
+        return self._results(*self._top(distances, top_k))
+
+    def _top(self, distances, top_k):
+        # indices and distances of the top_k smallest distances of every row
+        if top_k < distances.shape[1]:
+            top = np.argpartition(distances, top_k - 1, axis=1)[:, :top_k]
+        else:
+            top = np.broadcast_to(np.arange(distances.shape[1]),
+                                  distances.shape)
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_distances = np.take_along_axis(top_distances, order, axis=1)
+        return top, top_distances
+
+    def _match_samples(self, face_encodings, top_k):
+        faces = np.asarray(face_encodings, dtype=np.float32).reshape(
+            -1, self.samples.shape[1])
+        shortlist = min(max(top_k, self.rerank), len(self))
+        # stage 1: identities by the lower bound of their sample distances
+        if self.index is not None:
+            candidates, _ = self.index.search(faces, shortlist)
+        else:
+            bounds = self.face_distances(faces) - self.spreads[None, :]
+            candidates, _ = self._top(bounds, shortlist)
+        # stage 2: the samples of the shortlisted identities
+        tops, top_distances = [], []
+        for face, identities in zip(faces, candidates):
+            identities = identities[identities >= 0]
+            top = np.full(top_k, -1, dtype=np.intp)
+            top_distance = np.full(top_k, np.inf, dtype=np.float32)
+            tops.append(top)
+            top_distances.append(top_distance)
+            if not len(identities):
+                continue
+            starts = self.sample_offsets[identities]
+            ends = self.sample_offsets[identities + 1]
+            rows = np.concatenate([np.arange(start, end) for start, end
+                                   in zip(starts, ends)])
+            distances = face @ face - 2 * self.samples[rows] @ face \
+                + self._sample_norms[rows]
+            distances = np.sqrt(np.maximum(distances, 0))
+            # closest sample of every identity
+            identity_distances = np.minimum.reduceat(
+                distances, np.cumsum(ends - starts) - (ends - starts))
+            order = np.argsort(identity_distances, kind='stable')[:top_k]
+            top[:len(order)] = identities[order]
+            top_distance[:len(order)] = identity_distances[order]
+        return self._results(tops, top_distances)
+
+    def _results(self, top, top_distances):
+        matches = []
+        for indices, face_distances in zip(top, top_distances):
+            index = int(indices[0])
+            distance = float(face_distances[0])
+            # index -1 means the index found no candidate at all
+            is_match = index >= 0 and distance <= self.tolerance
+            name = self.known_face_names[index] if is_match \
+                else self.unknown_name
+            matches.append(FaceMatch(name, index, distance, is_match,
+                                     indices, face_distances))
+        return matches
+
+    def match_names(self, face_encodings):
+        """
+        Return the name of the best match for every face encoding,
+        'Unknown' for faces without a match.
+        """
+        return [match.name for match in self.match(face_encodings)]
@@ -0,0 +1,188 @@
+"""
+Offline attendance of recorded meetings on all cores.
+
+The video is split into shards of a fixed number of frames. Worker
+processes seek to their shard and run the same FaceRecognizer as the live
+program on it. The per-shard detections are merged into one attendance
+timeline: for every person the time ranges they were seen in.
+
+Example:
+    python offline.py "video/Video conference at ZOOM.mp4" \\
+        --class-path class_trofim --workers 8 --output timeline.json
+
+Shards don't depend on the number of workers, so the timeline is the same
+for any --workers.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+from time import time
+
+import cv2 as cv
+
+from gallery import load_gallery
+from recognition import FaceRecognizer
+from registry import load_matcher
+from xlsx import xlsx_file_create_new, xlsx_file_write_session
+
+# matcher of a worker process, see init_worker()
+worker_matcher = None
+
+
+def init_worker(path, tolerance):
+    # every worker maps the same gallery.bin, so the pages are shared
+    global worker_matcher
+    worker_matcher = load_matcher(path, tolerance)
+
+
+def video_info(file_path):
+    """Return (frame count, fps) of a video file."""
+    capture = cv.VideoCapture(file_path)
+    if not capture.isOpened():
+        raise Exception('Video source not found: {}'.format(file_path))
+    frames = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv.CAP_PROP_FPS) or 25
+    capture.release()
+    return frames, fps
+
+
+def split_frames(frames, shard_frames, frame_rate):
+    """
+    Return the (start, end) frame ranges of the shards. Shards start on a
+    multiple of frame_rate, so the detections run on the same frames as in
+    one pass over the video.
+    """
+    shard_frames = max(frame_rate, shard_frames // frame_rate * frame_rate)
+    return [(start, min(start + shard_frames, frames))
+            for start in range(0, frames, shard_frames)]
+
+
+def process_shard(args):
+    """
+    Recognize the faces of frames start to end of a video file. Returns the
+    detections as (frame, identity, distance, track) tuples; track numbers
+    the tracks of the shard in order of appearance.
+    """
+    file_path, start, end, resize, frame_rate = args
+    capture = cv.VideoCapture(file_path)
+    capture.set(cv.CAP_PROP_POS_FRAMES, start)
+    if int(capture.get(cv.CAP_PROP_POS_FRAMES)) != start:
+        # the container can't seek to the exact frame, skip the frames
+        # before the shard without decoding them
+        capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+        for _ in range(start):
+            capture.grab()
+    recognizer = FaceRecognizer(worker_matcher, resize, frame_rate)
+    tracks = {}
+    detections = []
+    for frame_number in range(start, end):
+        ok, screenshot = capture.read()
+        if not ok:
+            break
+        recognizer.process(screenshot)
+        if not recognizer.detected:
+            continue
+        for track in recognizer.tracker.tracks:
+            if track.misses == 0 and track.identity is not None:
+                # track ids of a process depend on its earlier shards
+                number = tracks.setdefault(track.id, len(tracks))
+                detections.append((frame_number, track.identity,
+                                   float(track.distance), number))
+    capture.release()
+    return detections
+
+
+def timeline(detections, names, fps, gap=10, min_detections=1):
+    """
+    Merge the detections of all shards into {name: [(start, end,
+    detections)]}, start and end in seconds. Detections of a person less
+    than gap seconds apart belong to the same range. People seen in fewer
+    than min_detections detections are left out.
+    """
+    seen = {}
+    for frame, identity, _, _ in sorted(detections):
+        seen.setdefault(identity, []).append(frame / fps)
+    result = {}
+    for identity, times in sorted(seen.items()):
+        if len(times) < min_detections:
+            continue
+        ranges = []
+        for moment in times:
+            if ranges and moment - ranges[-1][1] <= gap:
+                ranges[-1][1] = moment
+                ranges[-1][2] += 1
+            else:
+                ranges.append([moment, moment, 1])
+        name = names[identity] if identity >= 0 else 'UNKNOWN'
+        result[name] = [tuple(item) for item in ranges]
+    return result
+
+
+def process_video(file_path, path, workers=None, shard_seconds=120, resize=2,
+                  frame_rate=25, tolerance=0.6):
+    """
+    Recognize the faces of a whole video file on workers processes (all
+    cores by default). Returns (detections, fps) with the detections of
+    all shards in frame order.
+    """
+    frames, fps = video_info(file_path)
+    shards = split_frames(frames, int(shard_seconds * fps), frame_rate)
+    workers = min(workers or os.cpu_count() or 1, len(shards)) or 1
+    print(f'{frames} frames, {len(shards)} shards, {workers} workers')
+    tasks = [(file_path, start, end, resize, frame_rate)
+             for start, end in shards]
+    detections = []
+    with multiprocessing.Pool(workers, init_worker,
+                              (path, tolerance)) as pool:
+        # imap keeps the shard order, whatever worker finishes first
+        for shard, shard_detections in enumerate(pool.imap(process_shard,
+                                                           tasks)):
+            detections.extend((frame, identity, distance, (shard, track))
+                              for frame, identity, distance, track
+                              in shard_detections)
+            print(f'Shard {shard + 1}/{len(shards)} done')
+    return detections, fps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('video', help='recorded meeting')
+    parser.add_argument('--class-path', default='class_trofim')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--shard-seconds', type=float, default=120)
+    parser.add_argument('--resize', type=float, default=2)
+    parser.add_argument('--frame-rate', type=int, default=25,
+                        help='run the detection every frame_rate frames')
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--gap', type=float, default=10,
+                        help='seconds between detections of a person that '
+                             'still count as one range')
+    parser.add_argument('--min-detections', type=int, default=1)
+    parser.add_argument('--output', default='timeline.json')
+    parser.add_argument('--session', default=None,
+                        help='also write the attendance of this session '
+                             'into attendance.xlsx')
+    args = parser.parse_args()
+
+    start_time = time()
+    names, _, _ = load_gallery(args.class_path)
+    detections, fps = process_video(args.video, args.class_path, args.workers,
+                                    args.shard_seconds, args.resize,
+                                    args.frame_rate, args.tolerance)
+    result = timeline(detections, list(names), fps, args.gap,
+                      args.min_detections)
+    with open(args.output, 'w') as file:
+        json.dump({'video': args.video, 'class': args.class_path,
+                   'fps': fps, 'timeline': result}, file, indent=2)
+    print(f'Timeline of {len(result)} people saved into file {args.output} '
+          f'({time() - start_time:.1f} sec)')
+    if args.session:
+        if not os.path.isfile(os.path.join(args.class_path, 'attendance.xlsx')):
+            xlsx_file_create_new(args.class_path, list(names))
+        xlsx_file_write_session(args.class_path, args.session, set(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import cv2 as cv
+import face_recognition as fr
+import numpy as np
+
+ENCODE, DEFER, SKIP = 'encode', 'defer', 'skip'
+
+
+class FaceQuality:
+    """
+    Class that checks a detected face before the expensive encoding.
+
+    The checks, cheapest first:
+        size       - height of the box in pixels of the processed frame,
+        brightness - mean gray level of the face,
+        sharpness  - variance of the Laplacian of the face scaled to 64x64
+                     (blurred faces have few edges),
+        yaw, roll  - head pose from the 5 point landmarks: horizontal offset
+                     of the nose from the middle of the eyes (relative to
+                     the eye distance) and the angle of the eye line.
+    A threshold set to None disables its check.
+
+    check() decides per track: ENCODE if every check passes, DEFER if one
+    fails (the track is checked again on the next frame, maybe the face
+    turns or gets sharp), SKIP if the face is smaller than skip_size or
+    was deferred max_deferrals times. Skipped tracks wait for the next
+    detection, which checks them again with max_deferrals new chances, so
+    somebody who looked down when first detected is still identified.
+    """
+
+    def __init__(self, min_size=40, min_brightness=40, max_brightness=220,
+                 min_sharpness=20, max_yaw=0.3, max_roll=25, skip_size=20,
+                 max_deferrals=5):
+        self.min_size = min_size
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.min_sharpness = min_sharpness
+        self.max_yaw = max_yaw
+        self.max_roll = max_roll
+        self.skip_size = skip_size
+        self.max_deferrals = max_deferrals
+        self.decisions = {ENCODE: 0, DEFER: 0, SKIP: 0}
+
+    def measure(self, frame, gray, location):
+        """
+        Return the measures of the face at location that are needed to
+        decide, in the order of the checks (a failed check stops it).
+        """
+        top, right, bottom, left = location
+        height, width = gray.shape[:2]
+        top, bottom = max(0, top), min(height, bottom)
+        left, right = max(0, left), min(width, right)
+        measures = {'size': bottom - top}
+        if self.min_size is not None and measures['size'] < self.min_size \
+                or right <= left:
+            return measures
+        face = gray[top:bottom, left:right]
+        measures['brightness'] = float(face.mean())
+        if self.min_brightness is not None \
+                and measures['brightness'] < self.min_brightness \
+                or self.max_brightness is not None \
+                and measures['brightness'] > self.max_brightness:
+            return measures
+        if self.min_sharpness is not None:
+            face = cv.resize(face, (64, 64), interpolation=cv.INTER_AREA)
+            measures['sharpness'] = float(cv.Laplacian(face, cv.CV_64F).var())
+            if measures['sharpness'] < self.min_sharpness:
+                return measures
+        if self.max_yaw is not None or self.max_roll is not None:
+            measures.update(self.pose(frame, location))
+        return measures
+
+    @staticmethod
+    def pose(frame, location):
+        landmarks = fr.face_landmarks(frame, [location], model='small')
+        if not landmarks:
+            return {'yaw': np.inf, 'roll': np.inf}
+        landmarks = landmarks[0]
+        left_eye = np.mean(landmarks['left_eye'], axis=0)
+        right_eye = np.mean(landmarks['right_eye'], axis=0)
+        nose = np.asarray(landmarks['nose_tip'][0], dtype=np.float64)
+        dx, dy = right_eye - left_eye
+        eye_distance = np.hypot(dx, dy)
+        if not eye_distance:
+            return {'yaw': np.inf, 'roll': np.inf}
+        middle = (left_eye + right_eye) / 2
+        return {'yaw': float(abs(nose[0] - middle[0]) / eye_distance),
+                'roll': float(abs(np.degrees(np.arctan2(dy, dx))))}
+
+    def passed(self, measures):
+        if self.min_size is not None and measures['size'] < self.min_size:
+            return False
+        for name, low, high in (
+                ('brightness', self.min_brightness, self.max_brightness),
+                ('sharpness', self.min_sharpness, None),
+                ('yaw', None, self.max_yaw),
+                ('roll', None, self.max_roll)):
+            if low is None and high is None:
+                continue
+            value = measures.get(name)
+            if value is None or low is not None and value < low \
+                    or high is not None and value > high:
+                return False
+        return True
+
+    def check(self, frame, gray, track):
+        """Decide whether track is encoded now. Sets track.quality."""
+        if track.quality == SKIP:
+            # checked again on a detection, a new round of deferrals
+            track.deferrals = 0
+        location = track.location()
+        if self.skip_size is not None \
+                and location[2] - location[0] < self.skip_size:
+            decision = SKIP
+        elif self.passed(self.measure(frame, gray, location)):
+            decision = ENCODE
+        elif self.max_deferrals is None \
+                or track.deferrals < self.max_deferrals:
+            decision = DEFER
+            track.deferrals += 1
+        else:
+            decision = SKIP
+        track.quality = decision
+        self.decisions[decision] += 1
+        return decision
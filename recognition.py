@@ -0,0 +1,381 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Condition, Thread
+from time import time
+
+import cv2 as cv
+import face_recognition as fr
+import numpy as np
+
+from changes import overlaps
+from classes import StageTimer, metrics
+from quality import ENCODE, SKIP
+from tracker import FaceTracker
+
+
+class FaceRecognizer:
+    """
+    Class that finds and names the faces on screenshots.
+
+    Every frame_rate-th screenshot (or earlier, when the tracker loses a
+    face) runs the full detection with fr.face_locations. Only faces that
+    are new to the tracker are encoded and matched, known faces keep their
+    names. On the screenshots in between the boxes follow the faces with
+    the tracker. With tiles (a GalleryTiles) the detection runs tile by
+    tile on a Zoom gallery view. With a LatencyScheduler resize and
+    frame_rate are adjusted after every screenshot to meet its latency
+    budget. With an AttendanceLog every detection records an event for
+    every face seen. With a DetectorPool detection and encoding run on the
+    pool, so several recognizers can share its worker processes. With
+    UnknownFaces the unknown faces are clustered, and repeat strangers are
+    resolved by their cluster instead of a search of the whole gallery.
+    With a FaceQuality gate a new face is only encoded once it is big,
+    sharp, frontal and lit well enough (checked on every screenshot until
+    then); its name stays None meanwhile. encoded counts the encoded faces.
+    With a ChangeDetector the detection only runs on the regions that
+    changed since the last one; the boxes in unchanged regions are kept,
+    and a screenshot without changes needs no detection at all.
+    detector_calls and detected_pixels count the work of the detector.
+    timings holds the duration in seconds of every stage of the last
+    process() call.
+    """
+
+    def __init__(self, matcher, resize=2, frame_rate=100, tracker=None,
+                 tiles=None, scheduler=None, attendance=None, pool=None,
+                 unknowns=None, quality=None, changes=None):
+        self.matcher = matcher
+        self.resize = resize  # how many times the screenshot is reduced
+        self.frame_rate = frame_rate
+        self.frame_count = 1
+        self.tracker = tracker or FaceTracker()
+        self.tiles = tiles
+        self.scheduler = scheduler
+        self.attendance = attendance
+        self.pool = pool
+        self.unknowns = unknowns
+        self.quality = quality
+        self.changes = changes
+        self.encoded = 0
+        self.detector_calls = 0
+        self.detected_pixels = 0
+        self._next_matcher = None
+        self.detected = False  # whether the last process() ran detection
+        self.timings = {}
+
+    def process(self, screenshot):
+        """
+        Find and name the faces on a BGR screenshot.
+        Returns (face_locations, face_names), the locations are
+        (top, right, bottom, left) in screenshot coordinates.
+        """
+        if self._next_matcher is not None:
+            self.matcher, self.attendance = self._next_matcher
+            self._next_matcher = None
+            # identities of the tracks belong to the old gallery, so may
+            # the clusters of unknown faces
+            self.tracker.reset()
+            if self.changes is not None:
+                self.changes.reset()
+            if self.unknowns is not None:
+                self.unknowns.clear()
+            self.frame_count = 1
+        timings = {}
+        time_fr = time()
+        if self.resize != 1:
+            frame = cv.resize(screenshot, (0, 0), fx=1 / self.resize,
+                              fy=1 / self.resize)
+        else:
+            frame = screenshot
+        # Convert the image from BGR color (which OpenCV uses) to RGB color
+        # (which face_recognition uses)
+        frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB)
+        gray = cv.cvtColor(frame, cv.COLOR_RGB2GRAY)
+        timings['resize'] = time() - time_fr
+
+        self.detected = self.frame_count == 1 or self.tracker.lost
+        if self.detected:
+            self.detect(frame, gray, timings)
+        else:
+            time_fr = time()
+            self.tracker.predict(gray)
+            timings['track'] = time() - time_fr
+            if self.quality is not None:
+                self.encode_pending(frame, gray, timings)
+
+        if self.frame_count >= self.frame_rate:
+            self.frame_count = 1
+        else:
+            self.frame_count += 1
+        self.timings = timings
+        face_locations = self.face_locations()
+        if self.scheduler is not None:
+            self.schedule()
+        return face_locations, self.tracker.names()
+
+    def set_matcher(self, matcher, attendance=None):
+        """
+        Switch to another gallery (and attendance log). Takes effect on the
+        next process() call, which starts over with a full detection.
+        """
+        self._next_matcher = (matcher, attendance)
+
+    def schedule(self):
+        self.scheduler.record(self.timings, self.detected)
+        self.frame_rate = self.scheduler.frame_rate
+        if self.scheduler.resize != self.resize:
+            # boxes are kept in the coordinates of the resized screenshot
+            self.tracker.rescale(self.resize / self.scheduler.resize)
+            self.resize = self.scheduler.resize
+
+    def detect(self, frame, gray, timings):
+        # Find all the faces in the screenshot
+        time_fr = time()
+        regions = None
+        if self.changes is not None:
+            regions = self.changes.changed_regions(gray)
+        if regions is None:
+            face_locations = self.find_faces(frame, gray)
+        else:
+            # boxes outside of the changed regions are still valid
+            face_locations = [location for location in self.tracker.locations()
+                              if not any(overlaps(location, region)
+                                         for region in regions)]
+            for top, right, bottom, left in regions:
+                for face_top, face_right, face_bottom, face_left in \
+                        self.find_faces(np.ascontiguousarray(
+                            frame[top:bottom, left:right])):
+                    face_locations.append((face_top + top, face_right + left,
+                                           face_bottom + top,
+                                           face_left + left))
+        timings['detect'] = time() - time_fr
+
+        time_fr = time()
+        new_tracks = self.tracker.update(gray, face_locations)
+        timings['track'] = time() - time_fr
+        if self.quality is not None:
+            self.encode_pending(frame, gray, timings, detected=True)
+        elif new_tracks:
+            self.encode(frame, new_tracks, timings)
+
+        if self.attendance is not None:
+            timestamp = time()
+            for track in self.tracker.tracks:
+                if track.misses == 0 and track.identity is not None:
+                    self.attendance.record(track.identity, track.distance,
+                                           track.id, timestamp)
+
+    def find_faces(self, frame, gray=None):
+        # gray is given for whole screenshots only, tiles need the grid
+        self.detector_calls += 1
+        self.detected_pixels += frame.shape[0] * frame.shape[1]
+        if self.tiles is not None and gray is not None:
+            return self.tiles.face_locations(frame, gray)
+        if self.pool is not None:
+            return self.pool.face_locations(frame)
+        return fr.face_locations(frame)
+
+    def encode_pending(self, frame, gray, timings, detected=False):
+        # New faces and the ones the quality gate deferred so far, skipped
+        # faces get another chance on detection frames
+        tracks = [track for track in self.tracker.tracks
+                  if track.encoding is None
+                  and (detected or track.quality != SKIP)]
+        if not tracks:
+            return
+        time_fr = time()
+        tracks = [track for track in tracks
+                  if self.quality.check(frame, gray, track) == ENCODE]
+        timings['quality'] = time() - time_fr
+        if tracks:
+            self.encode(frame, tracks, timings)
+
+    def encode(self, frame, tracks, timings):
+        # Encode and match only the faces that are new to the tracker
+        self.encoded += len(tracks)
+        time_fr = time()
+        face_locations = [track.location() for track in tracks]
+        if self.pool is not None:
+            face_encodings = self.pool.face_encodings(frame, face_locations)
+        else:
+            face_encodings = fr.face_encodings(frame, face_locations)
+        timings['encode'] = time() - time_fr
+
+        time_fr = time()
+        if self.unknowns is not None:
+            # strangers seen before are recognized by their cluster if they
+            # can't match a known face, the other faces are searched in the
+            # gallery
+            slots, cluster_distances = self.unknowns.match(
+                face_encodings, self.matcher.tolerance)
+        else:
+            slots = np.full(len(face_encodings), -1)
+        gallery_faces = np.flatnonzero(slots < 0)
+        matches = dict(zip(gallery_faces, self.matcher.match(
+            [face_encodings[i] for i in gallery_faces])))
+        for i, (track, encoding) in enumerate(zip(tracks, face_encodings)):
+            track.encoding = encoding
+            match = matches.get(i)
+            if match is not None and match.is_match:
+                track.name = match.name
+                track.identity = match.index
+                track.distance = match.distance
+                continue
+            track.name = self.matcher.unknown_name
+            track.identity = -1
+            if match is not None:
+                track.distance = match.distance
+            else:
+                track.distance = cluster_distances[i]
+            if self.unknowns is not None:
+                track.cluster = self.unknowns.add(
+                    encoding, frame, track.location(), slots[i],
+                    gallery_distance=track.distance if match is not None
+                    else 0)
+        timings['match'] = time() - time_fr
+
+    def face_locations(self):
+        # Scale back up face locations since
+        # the frame we detected in was scaled
+        return [tuple(int(round(x * self.resize)) for x in location)
+                for location in self.tracker.locations()]
+
+
+class DetectorPool:
+    """
+    Class that runs face detection and encoding for many FaceRecognizers
+    on one shared pool of workers.
+
+    Every call submits one task and waits for its result, so a recognizer
+    never has more than one task in the pool. The pool serves its tasks
+    first in, first out, so with one recognizer per stream every stream
+    gets its turn before any stream gets a second one, and a busy stream
+    can't starve the others. executor is 'process' (dlib holds the GIL, so
+    this is the one that scales with cores) or 'thread'.
+    """
+
+    def __init__(self, workers=None, executor='process'):
+        if executor == 'process':
+            self.executor = ProcessPoolExecutor(workers)
+        else:
+            self.executor = ThreadPoolExecutor(workers)
+
+    def face_locations(self, frame):
+        return self.executor.submit(fr.face_locations, frame).result()
+
+    def face_encodings(self, frame, face_locations):
+        return self.executor.submit(fr.face_encodings, frame,
+                                    face_locations).result()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def observe_timings(timings, stage_metrics):
+    # stage histograms are created on first use, the stages depend on the
+    # recognizer settings
+    for stage, duration in timings.items():
+        metric = stage_metrics.get(stage)
+        if metric is None:
+            metric = stage_metrics[stage] = metrics.histogram(stage)
+        metric.observe(duration)
+
+
+class RecognitionWorker:
+    """
+    Class that runs a FaceRecognizer on a dedicated thread.
+
+    submit() hands the newest screenshot over without waiting. A screenshot
+    that the worker hasn't picked up yet is replaced by the newer one
+    (latest frame wins), so recognition never works on stale screenshots.
+    result is (sequence, face_locations, face_names) of the last processed
+    screenshot and can be read at any time without blocking.
+    """
+
+    def __init__(self, recognizer, screenshot, name='RecognitionWorker'):
+        self.recognizer = recognizer
+        self.name = name
+        # the pending screenshot is copied into one buffer while the worker
+        # processes the other one
+        self._pending = np.empty_like(screenshot)
+        self._working = np.empty_like(screenshot)
+        self._pending_sequence = None
+        self._condition = Condition()
+        self.result = (-1, [], [])
+        self.timings = {}
+        self.dropped = 0  # screenshots replaced before they were processed
+        self._dropped_metric = metrics.counter('recognition_dropped')
+        self._stage_metrics = {}
+        self.timer = StageTimer('recognition')
+        self.stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self.run, name=self.name, args=(),
+                              daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, screenshot, sequence):
+        with self._condition:
+            if self._pending_sequence is not None:
+                self.dropped += 1
+                self._dropped_metric.inc()
+            np.copyto(self._pending, screenshot)
+            self._pending_sequence = sequence
+            self._condition.notify()
+
+    def run(self):
+        while not self.stopped:
+            with self._condition:
+                self.timer.switch(False)
+                # submit() and stop() wake the thread up
+                self._condition.wait_for(
+                    lambda: self._pending_sequence is not None
+                    or self.stopped)
+                self.timer.switch(True)
+                if self.stopped:
+                    break
+                self._pending, self._working = self._working, self._pending
+                sequence = self._pending_sequence
+                self._pending_sequence = None
+            face_locations, face_names = self.recognizer.process(
+                self._working)
+            self.timings = self.recognizer.timings
+            observe_timings(self.timings, self._stage_metrics)
+            # one assignment, so readers always see a consistent result
+            self.result = (sequence, face_locations, face_names)
+
+    def stop(self):
+        with self._condition:
+            self.stopped = True
+            self._condition.notify()
+        # the screenshot in progress is finished first
+        if self._thread is not None:
+            self._thread.join()
+
+
+def draw_faces(frame, face_locations, face_names):
+    """
+    Draw boxes and name plates of the faces on frame, in place. Faces
+    without a name (not encoded yet) get only the box.
+    """
+    for (top, right, bottom, left), name in zip(face_locations, face_names):
+        if name is None:
+            cv.rectangle(frame, (left, top), (right, bottom), (255, 0, 255), 2)
+            continue
+        # Draw a box around the face
+        name_len = len(name)
+        frame_width = right - left
+        name_plate_width = name_len * 10  # 10 is width of one letter approximately.
+        if frame_width < name_plate_width:
+            d_left = int((name_plate_width - frame_width) / 2)
+        else:
+            d_left = 1
+        cv.rectangle(frame, (left, top), (right, bottom), (255, 0, 255), 2)
+
+        # Draw a label with a name below the face
+        cv.rectangle(frame, (left - d_left, bottom),
+                     (right + d_left, bottom + 35),
+                     (255, 0, 255), cv.FILLED)
+        cv.putText(frame, name, (left - d_left + 5, bottom + 20),
+                   cv.FONT_HERSHEY_COMPLEX, 0.5, (255, 255, 255), 1)
+    return frame
@@ -0,0 +1,137 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from face_index import INDEX_FILE, load_face_index
+from gallery import GALLERY_FILE, load_gallery, load_samples
+from matcher import FaceMatcher
+
+# files of a class folder whose change means the class must be reloaded
+CLASS_FILES = (GALLERY_FILE, 'names.npy', 'face_encodings.npy', INDEX_FILE)
+
+
+def load_matcher(path, tolerance=0.6):
+    """
+    Return the FaceMatcher of class folder path with its IVFIndex and
+    samples, if the class has them.
+    """
+    names, encodings, norms = load_gallery(path)
+    return FaceMatcher(encodings, names, tolerance,
+                       index=load_face_index(path, encodings),
+                       known_norms=norms, **load_samples(path))
+
+
+def is_class_folder(path):
+    """Whether path is a class folder made by setup_class()."""
+    return os.path.isfile(os.path.join(path, GALLERY_FILE)) or (
+        os.path.isfile(os.path.join(path, 'names.npy'))
+        and os.path.isfile(os.path.join(path, 'face_encodings.npy')))
+
+
+class GalleryRegistry:
+    """
+    Class that finds the class folders under root and loads their
+    galleries on first use.
+
+    get() returns a FaceMatcher of a class (with its IVFIndex, if the class
+    has one). Loaded classes are kept in least recently used order and the
+    oldest ones are dropped when the loaded galleries take more than
+    max_bytes (the class just requested is always kept). refresh() checks
+    the size and mtime of the files of the loaded classes and reloads only
+    the classes that changed on disk (setup_class() replaces the files, so
+    a new gallery always gets a new mtime).
+    """
+
+    def __init__(self, root='.', max_bytes=2 * 2 ** 30, tolerance=0.6):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self._loaded = OrderedDict()  # class name -> (stamp, matcher, nbytes)
+        self._lock = Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def classes(self):
+        """Names of the class folders under root."""
+        return sorted(name for name in os.listdir(self.root)
+                      if is_class_folder(os.path.join(self.root, name)))
+
+    def path(self, class_name):
+        return os.path.join(self.root, class_name)
+
+    def _stamp(self, class_name):
+        stamp = []
+        for file in CLASS_FILES:
+            try:
+                stat = os.stat(os.path.join(self.path(class_name), file))
+            except FileNotFoundError:
+                continue
+            stamp.append((file, stat.st_size, stat.st_mtime_ns))
+        return tuple(stamp)
+
+    @staticmethod
+    def _nbytes(matcher):
+        nbytes = matcher.known_face_encodings.nbytes \
+            + matcher._known_norms.nbytes
+        if matcher.samples is not None:
+            nbytes += matcher.samples.nbytes + matcher._sample_norms.nbytes
+        index = matcher.index
+        if index is not None:
+            nbytes += sum(array.nbytes for array in (
+                index.centroids, index.list_offsets, index.list_ids,
+                index.pq_codebooks, index.pq_codes) if array is not None)
+        return nbytes
+
+    def _load(self, class_name):
+        path = self.path(class_name)
+        if not is_class_folder(path):
+            raise ValueError('Not a class folder: {}'.format(path))
+        # stamp first, so a change during loading is seen by refresh()
+        stamp = self._stamp(class_name)
+        matcher = load_matcher(path, self.tolerance)
+        self._loaded[class_name] = (stamp, matcher, self._nbytes(matcher))
+        self._loaded.move_to_end(class_name)
+        self.loads += 1
+        self._evict()
+        return matcher
+
+    def _evict(self):
+        while len(self._loaded) > 1 and self.nbytes > self.max_bytes:
+            self._loaded.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def nbytes(self):
+        return sum(nbytes for _, _, nbytes in self._loaded.values())
+
+    def loaded(self):
+        """Names of the loaded classes, least recently used first."""
+        return list(self._loaded)
+
+    def get(self, class_name):
+        """Return the FaceMatcher of a class, loading it if needed."""
+        with self._lock:
+            if class_name in self._loaded:
+                self._loaded.move_to_end(class_name)
+                return self._loaded[class_name][1]
+            return self._load(class_name)
+
+    def refresh(self):
+        """
+        Reload the loaded classes that changed. Returns (changed, removed):
+        the names of the reloaded classes and of the classes that are no
+        class folder any more (they are dropped, get() raises for them).
+        """
+        changed = []
+        removed = []
+        with self._lock:
+            for class_name, (stamp, _, _) in list(self._loaded.items()):
+                if self._stamp(class_name) == stamp:
+                    continue
+                if is_class_folder(self.path(class_name)):
+                    self._load(class_name)
+                    changed.append(class_name)
+                else:
+                    del self._loaded[class_name]
+                    removed.append(class_name)
+        return changed, removed
@@ -0,0 +1,106 @@
+class LatencyScheduler:
+    """
+    Class that picks resize and frame_rate at runtime to meet a latency
+    budget, e.g. "detection result at most 0.5 sec old at 30 FPS display".
+
+    record() takes the stage timings of every FaceRecognizer.process() call
+    and keeps an exponential moving average per stage. The age of the
+    newest detection result is at most
+        frame_rate * frame_time + detection_time
+    where frame_time is the cost of a tracking screenshot (never less than
+    one display frame) and detection_time covers resize, detection,
+    encoding and matching. The scheduler:
+        - reduces the screenshot more (bigger resize) when the detection
+          alone takes more than half of the budget or tracking can't keep
+          up with the display rate,
+        - reduces it less (smaller resize, better recall) when the
+          detection takes less than a quarter of the budget,
+        - then sets frame_rate as big as the rest of the budget allows.
+    A resize change waits for cooldown detections, so the averages can
+    settle on the new scale first.
+    """
+    resize_steps = (1, 1.5, 2, 3, 4)
+    detection_stages = ('resize', 'detect', 'encode', 'match')
+
+    def __init__(self, max_result_age=0.5, display_fps=30, resize=2,
+                 frame_rate=100, min_frame_rate=1, max_frame_rate=300,
+                 smoothing=0.2, cooldown=3):
+        self.max_result_age = max_result_age
+        self.display_fps = display_fps
+        self.resize = resize
+        self.frame_rate = frame_rate
+        self.min_frame_rate = min_frame_rate
+        self.max_frame_rate = max_frame_rate
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+        self.stage_times = {}  # average duration of every stage
+        self.detection_time = None
+        self.frame_time = None
+        self._detections = 0
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def record(self, timings, detected):
+        """Add the timings of one process() call and update the decisions."""
+        for stage, duration in timings.items():
+            self.stage_times[stage] = self._average(
+                self.stage_times.get(stage), duration)
+        if detected:
+            self.detection_time = self._average(
+                self.detection_time,
+                sum(timings.get(stage, 0) for stage in self.detection_stages))
+            self._detections += 1
+            self._decide_resize()
+        else:
+            self.frame_time = self._average(self.frame_time,
+                                            sum(timings.values()))
+        self._decide_frame_rate()
+
+    def _decide_resize(self):
+        if self._detections < self.cooldown:
+            return
+        steps = list(self.resize_steps)
+        step = min(range(len(steps)),
+                   key=lambda i: abs(steps[i] - self.resize))
+        display_time = 1 / self.display_fps
+        if (self.detection_time > self.max_result_age / 2
+                or (self.frame_time or 0) > display_time) \
+                and step < len(steps) - 1:
+            step += 1
+        elif self.detection_time < self.max_result_age / 4 \
+                and (self.frame_time or 0) < display_time / 2 and step > 0:
+            step -= 1
+        else:
+            return
+        # detection cost goes with the number of pixels
+        factor = (self.resize / steps[step]) ** 2
+        self.detection_time *= factor
+        if self.frame_time is not None:
+            self.frame_time *= factor
+        self.resize = steps[step]
+        self._detections = 0
+
+    def _decide_frame_rate(self):
+        if self.detection_time is None:
+            return
+        frame_time = max(self.frame_time or 0, 1 / self.display_fps)
+        frame_rate = int((self.max_result_age - self.detection_time)
+                         / frame_time)
+        self.frame_rate = min(max(frame_rate, self.min_frame_rate),
+                              self.max_frame_rate)
+
+    def decisions(self):
+        """Current decisions and the measurements they are based on."""
+        frame_time = max(self.frame_time or 0, 1 / self.display_fps)
+        return {'resize': self.resize,
+                'frame_rate': self.frame_rate,
+                'detection_time': self.detection_time,
+                'frame_time': self.frame_time,
+                'stage_times': dict(self.stage_times),
+                'max_result_age': self.max_result_age,
+                'expected_result_age':
+                    None if self.detection_time is None
+                    else self.frame_rate * frame_time + self.detection_time}
@@ -0,0 +1,285 @@
+"""
+Recognition service for many meetings at once.
+
+Every source (window name, video file, image folder, camera index or
+"synthetic") is a stream with its own capture thread, tracker, frame
+counter and results. Streams of the same class share one read-only gallery
+(gallery.bin is memory-mapped once), all streams share one pool of
+detection/encoding processes. A source is given as CLASS=SOURCE, or just
+SOURCE for the --class class; class folders are looked up under --root.
+
+Example:
+    python service.py --class class_trofim --workers 8 \\
+        "meeting_1.mp4" "class_other=meeting_2.mp4" 0
+"""
+import argparse
+from threading import Condition
+from time import time
+
+from attendance import AttendanceLog
+from classes import VideoGet, metrics
+from recognition import DetectorPool, FaceRecognizer, RecognitionWorker
+from registry import GalleryRegistry
+
+
+class RecognitionStream:
+    """
+    One source of a RecognitionService: a capture thread and a recognition
+    worker with its own FaceRecognizer, so tracks, frame counters and
+    results of different streams never mix. result is (sequence,
+    face_locations, face_names) of the last processed screenshot.
+    """
+
+    def __init__(self, name, src, recognizer, class_name, loop=False,
+                 fps=None, new_frame=None):
+        self.name = name
+        self.class_name = class_name
+        self.recognizer = recognizer
+        self.getter = VideoGet(src, loop=loop, fps=fps, new_frame=new_frame)
+        self.worker = RecognitionWorker(recognizer, self.getter.screenshot,
+                                        name=f'RecognitionWorker-{name}')
+        self.last_frame = -1
+        self.submitted = 0
+        self.start_time = None
+
+    @property
+    def stopped(self):
+        return self.getter.stopped
+
+    @property
+    def ready(self):
+        """Whether there is a new screenshot or the stream ended."""
+        return self.getter.frames != self.last_frame or self.getter.stopped
+
+    @property
+    def result(self):
+        return self.worker.result
+
+    def start(self):
+        self.start_time = time()
+        self.getter.start()
+        self.worker.start()
+        return self
+
+    def submit(self):
+        """Hand a new screenshot to the worker. Returns False if there is none."""
+        frames = self.getter.frames
+        if frames == self.last_frame:
+            return False
+        self.last_frame = frames
+        self.worker.submit(self.getter.screenshot, frames)
+        self.submitted += 1
+        return True
+
+    def stats(self):
+        elapsed = time() - self.start_time if self.start_time else 0
+        sequence, _, face_names = self.worker.result
+        processed = self.submitted - self.worker.dropped
+        return {'class': self.class_name,
+                'frames': self.getter.frames,
+                'processed': processed,
+                'dropped': self.worker.dropped,
+                'fps': processed / elapsed if elapsed else 0,
+                'result_age': self.last_frame - sequence,
+                'faces': list(face_names),
+                'capture_busy': self.getter.timer.utilization(),
+                'recognition_busy': self.worker.timer.utilization()}
+
+    def stop(self):
+        self.getter.stop()
+        self.worker.stop()
+
+
+class RecognitionService:
+    """
+    Class that recognizes faces on many streams with the galleries of a
+    GalleryRegistry and one shared DetectorPool.
+
+    Matchers are only read, so all streams of a class use the same one.
+    Every refresh_interval seconds the registry reloads the classes that
+    changed on disk and their streams switch to the new gallery (streams
+    of a removed class folder are stopped); a stream
+    can be moved to another class with set_class() at any time. With
+    attendance every class gets an AttendanceLog. Detection
+    and encoding of every stream go through the pool; each stream has at
+    most one task in it at a time (see DetectorPool), so the streams are
+    served round-robin and throughput scales with the pool's workers
+    instead of one process and one loaded gallery per meeting. Streams
+    whose screenshots come faster than they are recognized drop the stale
+    ones (latest frame wins).
+    """
+
+    def __init__(self, registry, workers=None, resize=2, frame_rate=100,
+                 attendance=False, executor='process', refresh_interval=10):
+        self.registry = registry
+        self.pool = DetectorPool(workers, executor)
+        self.resize = resize
+        self.frame_rate = frame_rate
+        self.attendance = attendance
+        self.refresh_interval = refresh_interval
+        self.attendance_logs = {}  # class name -> AttendanceLog
+        self.streams = {}
+        # notified by the capture threads of all streams
+        self.new_frame = Condition()
+
+    def _attendance_log(self, class_name, matcher):
+        if not self.attendance:
+            return None
+        attendance = self.attendance_logs.get(class_name)
+        if attendance is None:
+            attendance = AttendanceLog(self.registry.path(class_name),
+                                       matcher.known_face_names).start()
+            self.attendance_logs[class_name] = attendance
+        return attendance
+
+    def add_stream(self, name, src, class_name, loop=False, fps=None):
+        if name in self.streams:
+            raise ValueError('Stream already exists: {}'.format(name))
+        matcher = self.registry.get(class_name)
+        recognizer = FaceRecognizer(
+            matcher, self.resize, self.frame_rate,
+            attendance=self._attendance_log(class_name, matcher),
+            pool=self.pool)
+        stream = RecognitionStream(name, src, recognizer, class_name, loop,
+                                   fps, self.new_frame)
+        self.streams[name] = stream.start()
+        return stream
+
+    def set_class(self, name, class_name):
+        """Switch stream name to the gallery of another class."""
+        stream = self.streams[name]
+        matcher = self.registry.get(class_name)
+        stream.class_name = class_name
+        stream.recognizer.set_matcher(
+            matcher, self._attendance_log(class_name, matcher))
+
+    def refresh(self):
+        """
+        Reload the changed classes and switch their streams over. Streams
+        of removed classes are stopped.
+        """
+        changed, removed = self.registry.refresh()
+        for class_name in changed:
+            print(f'Class {class_name} changed, reloading')
+            attendance = self.attendance_logs.pop(class_name, None)
+            if attendance is not None:
+                # identities of the old gallery are written out first
+                attendance.stop()
+            for name, stream in self.streams.items():
+                if stream.class_name == class_name:
+                    self.set_class(name, class_name)
+        for class_name in removed:
+            print(f'Class {class_name} was removed, stopping its streams')
+            for name, stream in list(self.streams.items()):
+                if stream.class_name == class_name:
+                    self.remove_stream(name)
+            # the log can't write into the removed folder any more
+            attendance = self.attendance_logs.pop(class_name, None)
+            if attendance is not None:
+                attendance.stop()
+
+    def remove_stream(self, name):
+        self.streams.pop(name).stop()
+
+    def dispatch(self):
+        """
+        Hand the new screenshot of every stream to its worker and remove
+        the streams whose source is exhausted. Returns the number of
+        submitted screenshots.
+        """
+        submitted = 0
+        for name, stream in list(self.streams.items()):
+            if stream.stopped:
+                print(f'Stream {name} ended: {stream.stats()}')
+                self.remove_stream(name)
+            elif stream.submit():
+                submitted += 1
+        return submitted
+
+    def wait(self, timeout=None):
+        """Wait until a stream has a new screenshot or ended."""
+        with self.new_frame:
+            self.new_frame.wait_for(
+                lambda: any(stream.ready for stream in self.streams.values()),
+                timeout)
+
+    def stats(self):
+        return {name: stream.stats() for name, stream in self.streams.items()}
+
+    def run(self, duration=None, log_interval=5):
+        """
+        Dispatch screenshots until every stream has ended, duration seconds
+        have passed or Ctrl+C is pressed. Prints the stream stats every
+        log_interval seconds.
+        """
+        start_time = last_log = last_refresh = time()
+        try:
+            while self.streams:
+                if duration is not None and time() - start_time >= duration:
+                    break
+                if not self.dispatch():
+                    self.wait(timeout=0.5)
+                if self.refresh_interval \
+                        and time() - last_refresh >= self.refresh_interval:
+                    last_refresh = time()
+                    self.refresh()
+                if log_interval and time() - last_log >= log_interval:
+                    last_log = time()
+                    for name, stats in self.stats().items():
+                        print(f'{name}: {stats["fps"]:.1f} FPS, '
+                              f'dropped {stats["dropped"]}, '
+                              f'faces {stats["faces"]}')
+                    metrics.log()
+        except KeyboardInterrupt:
+            print('Service canceled!')
+
+    def stop(self):
+        for name in list(self.streams):
+            self.remove_stream(name)
+        self.pool.shutdown()
+        for attendance in self.attendance_logs.values():
+            attendance.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='+',
+                        help='window names, video files, image folders, '
+                             'camera indexes or "synthetic"')
+    parser.add_argument('--root', default='.',
+                        help='folder with the class folders')
+    parser.add_argument('--class', dest='class_name', default='class_trofim',
+                        help='class of the sources given without one')
+    parser.add_argument('--max-gallery-mb', type=float, default=2048,
+                        help='memory for loaded galleries')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='detection/encoding processes (default: cores)')
+    parser.add_argument('--resize', type=float, default=2)
+    parser.add_argument('--frame-rate', type=int, default=100)
+    parser.add_argument('--tolerance', type=float, default=0.6)
+    parser.add_argument('--fps', type=float, default=None,
+                        help='capture rate of every stream (default: as '
+                             'fast as the source gives screenshots)')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='stop after this many seconds')
+    parser.add_argument('--attendance', action='store_true',
+                        help='record attendance of the classes')
+    args = parser.parse_args()
+
+    registry = GalleryRegistry(args.root, int(args.max_gallery_mb * 2 ** 20),
+                               args.tolerance)
+    print('Classes found:', ', '.join(registry.classes()))
+    service = RecognitionService(registry, args.workers, args.resize,
+                                 args.frame_rate, args.attendance)
+    for number, source in enumerate(args.sources):
+        class_name, _, src = source.rpartition('=')
+        service.add_stream(f'{number}:{src}', src,
+                           class_name or args.class_name, fps=args.fps)
+    service.run(args.duration)
+    service.stop()
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,28 @@ import cv2 as cv
 import face_recognition as fr
 import os
 import contextlib
+import hashlib
+import multiprocessing
 import sys
 import numpy as np
 from tqdm import tqdm
 from tqdm.contrib import DummyTqdmFile
+from face_index import INDEX_FILE, IVFIndex
+from gallery import write_gallery
+from collections import namedtuple
 from xlsx import xlsx_file_create_new
 
+CACHE_FILE = 'encodings_cache.npz'
+# Person__2.jpg is another image of Person
+SAMPLE_SEPARATOR = '__'
+# subfolder of exported unknown faces (see unknowns.py), not enrolled
+UNKNOWN_FOLDER = 'unknown'
+
+# Cached enrollment result of one image. ok is False for images without a
+# recognizable face, then encoding and location are zeros.
+CacheEntry = namedtuple('CacheEntry', ['size', 'mtime', 'hash', 'ok',
+                                       'encoding', 'location'])
+
 
 @contextlib.contextmanager
 def std_out_err_redirect_tqdm():
@@ -32,48 +48,213 @@ def print_green(text):
     print("\033[32m{}\033[0m".format(text))
 
 
-def setup_class(path):
-    class_images = []  # LIST CONTAINING ALL THE IMAGES IN FOLDER.
-    known_face_names = []  # LIST CONTAINING ALL THE CORRESPONDING CLASS Names
-    known_face_encodings = []  # LIST CONTAINING ALL THE CORRESPONDING KNOWN FACE
-    img_list = []  # List containing images in target directory
+def file_hash(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_encodings_cache(path):
+    """
+    Read the per-image enrollment cache of the class folder.
+    Returns a dict {file name: CacheEntry}.
+    """
+    cache_file = f'{path}/{CACHE_FILE}'
+    if not os.path.isfile(cache_file):
+        return {}
+    data = np.load(cache_file)
+    return {str(file): CacheEntry(int(size), int(mtime), str(hash_),
+                                  bool(ok), encoding, tuple(location))
+            for file, size, mtime, hash_, ok, encoding, location in zip(
+                data['files'], data['sizes'], data['mtimes'],
+                data['hashes'], data['ok'], data['encodings'],
+                data['locations'])}
+
+
+def save_encodings_cache(path, cache):
+    files = list(cache)
+    entries = [cache[file] for file in files]
+    np.savez(f'{path}/{CACHE_FILE}',
+             files=np.array(files, dtype=str),
+             sizes=np.array([e.size for e in entries], dtype=np.int64),
+             mtimes=np.array([e.mtime for e in entries], dtype=np.int64),
+             hashes=np.array([e.hash for e in entries], dtype=str),
+             ok=np.array([e.ok for e in entries], dtype=bool),
+             encodings=np.array([e.encoding for e in entries],
+                                dtype=np.float64).reshape(-1, 128),
+             locations=np.array([e.location for e in entries],
+                                dtype=np.int64).reshape(-1, 4))
 
-    # List of files in target directory. There are different types of files.
-    # Not only images
-    file_list = os.listdir(path)
 
-    # Iterate directory
-    for file in file_list:
-        # check only image files
+def identity_name(image):
+    """
+    Name of the person on reference image: the subfolder for images in a
+    subfolder (Person/1.jpg), else the file name up to SAMPLE_SEPARATOR
+    (Person.jpg, Person__2.jpg).
+    """
+    folder, file = os.path.split(image)
+    if folder:
+        return folder
+    return os.path.splitext(file)[0].split(SAMPLE_SEPARATOR)[0]
+
+
+def list_images(path):
+    """
+    Return the reference images of a class folder, sorted: the .jpg files
+    of the folder and of its subfolders (one subfolder per person), except
+    UNKNOWN_FOLDER.
+    """
+    images = []
+    for file in sorted(os.listdir(path)):
         if file.endswith('.jpg'):
-            img_list.append(file)
+            images.append(file)
+        elif os.path.isdir(f'{path}/{file}') and file != UNKNOWN_FOLDER:
+            images.extend(f'{file}/{image}'
+                          for image in sorted(os.listdir(f'{path}/{file}'))
+                          if image.endswith('.jpg'))
+    return images
+
+
+def encode_image(file_path):
+    """
+    Find the face on a reference image and encode it.
+    Returns (ok, encoding, location), ok is False if the image can't be
+    read or has no face.
+    """
+    current_img = cv.imread(file_path)
+    if current_img is None:
+        return False, np.zeros(128), (0, 0, 0, 0)
+    current_img = cv.cvtColor(current_img, cv.COLOR_BGR2RGB)
+    locations = fr.face_locations(current_img)
+    if not locations:
+        return False, np.zeros(128), (0, 0, 0, 0)
+    encode = fr.face_encodings(current_img, locations[:1])[0]
+    return True, encode, tuple(locations[0])
+
+
+def cached_entry(path, image, cache, hashes):
+    """
+    Return the cache entry of image if the image hasn't changed since it was
+    cached, else None. Size and mtime are checked first, the content hash
+    only if they differ (file touched, copied or renamed). hashes maps
+    content hashes to cache entries.
+    """
+    stat = os.stat(f'{path}/{image}')
+    entry = cache.get(image)
+    if entry is not None and entry.size == stat.st_size \
+            and entry.mtime == stat.st_mtime_ns:
+        return entry
+    hash_ = file_hash(f'{path}/{image}')
+    entry = hashes.get(hash_)
+    if entry is not None:
+        return entry._replace(size=stat.st_size, mtime=stat.st_mtime_ns)
+    return CacheEntry(stat.st_size, stat.st_mtime_ns, hash_, None, None, None)
+
+
+def encode_images(file_paths, workers=None):
+    """
+    Yield encode_image() results for file_paths in order.
+    With more than one worker the images are decoded and encoded in a
+    process pool; only file paths go to the workers and only encodings
+    come back, so no image is ever held in this process.
+    """
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, len(file_paths))
+    if workers <= 1:
+        for file_path in file_paths:
+            yield encode_image(file_path)
+        return
+    # small chunks keep the progressbar moving and the order deterministic
+    chunksize = max(1, min(16, len(file_paths) // (workers * 8)))
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap(encode_image, file_paths, chunksize)
+
+
+def setup_class(path, index_min_size=10000, workers=None,
+                gallery_dtype=np.float32):
+    """
+    Encode the reference images of a class folder and save names.npy and
+    face_encodings.npy. Encodings are cached per image in
+    encodings_cache.npz, so a re-run only processes new or changed images
+    and drops deleted ones (the entries of the exported unknown faces in
+    UNKNOWN_FOLDER are kept). New images are encoded by workers processes
+    (all cores by default). The gallery is also saved as gallery.bin
+    (gallery_dtype np.float32 or np.float16) for fast, memory-mapped
+    loading.
+
+    A person can have several images (see identity_name()). Then the
+    person's encoding in the npy-files is the centroid of the images, and
+    gallery.bin also keeps every image encoding and the spread of the
+    person for two-stage matching.
+    """
+    known_face_names = []  # LIST CONTAINING ALL THE CORRESPONDING CLASS Names
+    known_face_encodings = []  # LIST CONTAINING ALL THE CORRESPONDING KNOWN FACE
+    known_face_metadata = []  # Reference image and face location of every known face
+    sample_encodings = []  # Encodings of all images, grouped by person
+    sample_offsets = [0]  # Images of person i are sample_encodings[offsets[i]:offsets[i + 1]]
+    spreads = []  # Largest distance of an image of a person to the centroid
+
+    # Reference images in the target directory and its subfolders
+    img_list = list_images(path)
     print('img_list', img_list)
     img_list_len = len(img_list)
 
-    print("Total People Detected in Class:", img_list_len)
+    print("Total Images Detected in Class:", img_list_len)
+
+    # Reuse the encodings of unchanged images
+    old_cache = load_encodings_cache(path)
+    hashes = {entry.hash: entry for entry in old_cache.values()}
+    cache = {}
+    for image in img_list:
+        cache[image] = cached_entry(path, image, old_cache, hashes)
+    # exported unknown faces (see unknowns.py) aren't enrolled, but their
+    # entries are kept until the images are renamed and moved out
+    for image, entry in old_cache.items():
+        if image.startswith(f'{UNKNOWN_FOLDER}/') \
+                and os.path.isfile(f'{path}/{image}'):
+            cache[image] = entry
+    new_images = [image for image in img_list if cache[image].ok is None]
+    print(f'Images to process: {len(new_images)}, '
+          f'from cache: {img_list_len - len(new_images)}')
 
     with std_out_err_redirect_tqdm() as orig_stdout:
-        pbar = tqdm(total=img_list_len, file=orig_stdout, dynamic_ncols=True,
+        pbar = tqdm(total=len(new_images), file=orig_stdout, dynamic_ncols=True,
                     bar_format='Processing: {percentage:3.0f}% |{bar:100}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]')  # Progressbar.
+        results = encode_images([f'{path}/{image}' for image in new_images],
+                                workers)
+        for image, (ok, encode, location) in zip(new_images, results):
+            cache[image] = cache[image]._replace(ok=ok, encoding=encode,
+                                                 location=location)
+            pbar.update()
+        pbar.close()
+        save_encodings_cache(path, cache)
+
+        # Bad images are reported on every run until they are replaced
+        person_images = {}
         for image in img_list:
-            current_img = cv.imread(f'{path}/{image}')
-            class_images.append(current_img)
-            name = os.path.splitext(image)[0]
-            known_face_names.append(name)
-            current_img = cv.cvtColor(current_img, cv.COLOR_BGR2RGB)
-            # print('image:', count, name)
-            try:
-                encode = fr.face_encodings(current_img)[0]
-            except IndexError:
+            if cache[image].ok:
+                person_images.setdefault(identity_name(image), []).append(image)
+            else:
                 print()
                 print_red(
                     f' ERROR: Image {path}/{image} wasn\'t recognize! It needs to be replaced. ')
                 print()
-
-            known_face_encodings.append(encode)
-            bad_image_flag = False
-            pbar.update()
-        pbar.close()
+        for name in sorted(person_images):
+            images = person_images[name]
+            encodings = np.array([cache[image].encoding for image in images])
+            centroid = encodings.mean(axis=0)
+            known_face_names.append(name)
+            known_face_encodings.append(centroid)
+            known_face_metadata.append(
+                {'image': images[0],
+                 'location': [int(x) for x in cache[images[0]].location],
+                 'images': images})
+            sample_encodings.extend(encodings)
+            sample_offsets.append(len(sample_encodings))
+            spreads.append(np.linalg.norm(encodings - centroid, axis=1).max())
+        print("Total People Detected in Class:", len(known_face_names))
         print()
         # print('known_face_encodings:', known_face_encodings)
         print('known_face_names:', len(known_face_names))
@@ -83,11 +264,29 @@ def setup_class(path):
         # Save recognized data to npy-files in target directory
         np.save(f'{path}/names.npy', known_face_names)
         print('File names.npy saved')
-        np.save(f'{path}/face_encodings.npy', known_face_encodings)
+        np.save(f'{path}/face_encodings.npy',
+                np.array(known_face_encodings).reshape(-1, 128))
         print('File face_encodings.npy saved')
+        if len(sample_encodings) > len(known_face_names):
+            # somebody has several images
+            write_gallery(path, known_face_names, known_face_encodings,
+                          known_face_metadata, gallery_dtype,
+                          sample_encodings, sample_offsets, spreads)
+        else:
+            write_gallery(path, known_face_names, known_face_encodings,
+                          known_face_metadata, gallery_dtype)
+        print('File gallery.bin saved')
+        # Big galleries get an approximate nearest neighbour index
+        index_file = f'{path}/{INDEX_FILE}'
+        if len(known_face_encodings) >= index_min_size:
+            IVFIndex().build(np.array(known_face_encodings)).save(path)
+            print(f'File {INDEX_FILE} saved')
+        elif os.path.isfile(index_file):
+            # the gallery is small again, drop the outdated index
+            os.remove(index_file)
 
         #Create new attendance xlsx-file
-        xlsx_file_create_new(path, known_face_names)
+        xlsx_file_create_new(path, list(known_face_names))
     return known_face_names, known_face_encodings
 
 
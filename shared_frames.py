@@ -0,0 +1,203 @@
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+from threading import Thread
+from time import time
+
+import numpy as np
+
+from classes import StageTimer, metrics
+from recognition import FaceRecognizer, observe_timings
+from registry import load_matcher
+
+
+class SharedFramePool:
+    """
+    Pool of frame slots in one multiprocessing.shared_memory block.
+
+    frame(slot) is a NumPy view of a slot, so processes attached to the
+    same pool (attach()) read and write frames without copying or
+    pickling them. The pool only holds the memory; which process owns a
+    slot is decided by whoever passes the slot indices around.
+    """
+
+    def __init__(self, slots, shape, dtype=np.uint8, name=None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.frames = np.ndarray((slots,) + self.shape, dtype=self.dtype,
+                                 buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def spec(self):
+        """Arguments of attach() in another process."""
+        return self.slots, self.shape, self.dtype.str, self.name
+
+    @classmethod
+    def attach(cls, slots, shape, dtype, name):
+        return cls(slots, shape, dtype, name)
+
+    def frame(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        # views of the buffer must be gone before it can be closed
+        self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def recognition_process(worker, spec, tasks, results, free, path, tolerance,
+                        resize):
+    """
+    Worker process of a ProcessRecognitionWorker. Takes slot indices from
+    tasks, recognizes the faces on the frame of the slot and gives the slot
+    back on free before it puts the result on results.
+    """
+    pool = SharedFramePool.attach(*spec)
+    matcher = load_matcher(path, tolerance)
+    # every frame gets a detection; faces that stay in place keep their
+    # tracks, so they are not encoded again
+    recognizer = FaceRecognizer(matcher, resize, frame_rate=1)
+    workers = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, sequence, workers = task
+        face_locations, face_names = recognizer.process(pool.frame(slot))
+        # the frame isn't needed any more, the recognizer works on its own
+        # resized copy
+        free.put(slot)
+        # track ids of different workers must not collide
+        events = [(track.identity, float(track.distance),
+                   track.id * workers + worker)
+                  for track in recognizer.tracker.tracks
+                  if track.misses == 0 and track.identity is not None]
+        results.put((sequence, face_locations, face_names, events,
+                     recognizer.timings))
+    pool.close()
+
+
+class ProcessRecognitionWorker:
+    """
+    Class that runs the recognition in workers processes, with the same
+    interface as RecognitionWorker (submit(), result, timings, dropped,
+    stop()).
+
+    submit() copies the screenshot into a free slot of a SharedFramePool
+    and passes only the slot index to the workers; the worker that takes it
+    gives the slot back as soon as it is done with the frame. So a slot is
+    always owned by exactly one side and frames are never pickled, only
+    the results come back over a queue. When every slot is in use the
+    screenshot is dropped (latest frame wins), or with block submit()
+    waits for a slot (backpressure for offline sources). A thread
+    collects the results: result is the newest one, and the recognition
+    events go to attendance.
+
+    Every worker runs the detection on every screenshot it gets, the
+    screenshots of a stream are spread over the workers.
+    """
+
+    def __init__(self, screenshot, path, workers=2, slots=None, resize=2,
+                 tolerance=0.6, attendance=None, block=False):
+        self.workers = workers
+        self.block = block
+        self.attendance = attendance
+        self.pool = SharedFramePool(slots or 2 * workers, screenshot.shape,
+                                    screenshot.dtype)
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._free = multiprocessing.Queue()
+        for slot in range(self.pool.slots):
+            self._free.put(slot)
+        self._processes = [
+            multiprocessing.Process(target=recognition_process,
+                                    name=f'RecognitionProcess-{worker}',
+                                    args=(worker, self.pool.spec(),
+                                          self._tasks, self._results,
+                                          self._free, path, tolerance,
+                                          resize), daemon=True)
+            for worker in range(workers)]
+        self.result = (-1, [], [])
+        self.timings = {}
+        self.dropped = 0
+        self._dropped_metric = metrics.counter('recognition_dropped')
+        self._stage_metrics = {}
+        self.timer = StageTimer('recognition_results')
+        self._thread = None
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._thread = Thread(target=self.collect, name='RecognitionResults',
+                              args=(), daemon=True)
+        self._thread.start()
+        return self
+
+    def _free_slot(self, timeout):
+        if not self.block:
+            return self._free.get(block=False)
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            # a dead worker never gives its slot back
+            if not any(process.is_alive() for process in self._processes):
+                raise Exception('Recognition processes stopped')
+            wait = 1 if deadline is None else min(1, deadline - time())
+            try:
+                return self._free.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if deadline is not None and time() >= deadline:
+                    raise
+
+    def submit(self, screenshot, sequence, timeout=None):
+        try:
+            slot = self._free_slot(timeout)
+        except queue.Empty:
+            # every slot is being recognized
+            self.dropped += 1
+            self._dropped_metric.inc()
+            return False
+        np.copyto(self.pool.frame(slot), screenshot)
+        self._tasks.put((slot, sequence, self.workers))
+        return True
+
+    def collect(self):
+        while True:
+            self.timer.switch(False)
+            item = self._results.get()
+            self.timer.switch(True)
+            if item is None:
+                break
+            sequence, face_locations, face_names, events, timings = item
+            if self.attendance is not None:
+                timestamp = time()
+                for identity, distance, track_id in events:
+                    self.attendance.record(identity, distance, track_id,
+                                           timestamp)
+            observe_timings(timings, self._stage_metrics)
+            # workers finish out of order, keep the newest result
+            if sequence > self.result[0]:
+                self.timings = timings
+                self.result = (sequence, face_locations, face_names)
+
+    def stop(self):
+        # the workers finish the queued screenshots first
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join()
+        self._results.put(None)
+        if self._thread is not None:
+            self._thread.join()
+        self.pool.close()
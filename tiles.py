@@ -0,0 +1,124 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2 as cv
+import face_recognition as fr
+import numpy as np
+
+
+def _runs(mask, min_length):
+    # (start, end) of the runs of True in mask that are at least min_length
+    # long
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return [(int(start), int(end)) for start, end in zip(starts, ends)
+            if end - start >= min_length]
+
+
+def detect_tile(tile, scale, upsample=0):
+    """
+    Find the faces on one RGB tile resized by scale. Returns the face
+    locations in tile coordinates.
+    """
+    if scale != 1:
+        tile = cv.resize(tile, (0, 0), fx=scale, fy=scale)
+    return [tuple(int(round(x / scale)) for x in location)
+            for location in fr.face_locations(tile, upsample)]
+
+
+class GalleryTiles:
+    """
+    Class that splits a Zoom gallery view screenshot into its participant
+    tiles and finds the faces on the tiles in parallel.
+
+    Tiles are separated by uniform lines (the dark gaps of the gallery
+    view). A row or column of pixels whose brightness barely changes along
+    it is a separator: the screenshot is first split into bands of rows,
+    then every band into tiles, so a centered, partly filled last row is
+    found as well. The grid is cached and only searched again when the
+    cached separator lines stop being uniform (layout change). Without a
+    grid (speaker view, screen share) nothing is cached, so a gallery
+    that shows up later is found on the next detection.
+
+    Every tile is resized so its height is tile_height before detection,
+    so small faces of big galleries get upsampled and big ones are not
+    processed at a needlessly high resolution. Without a grid the
+    screenshot is detected whole, like without tiles. executor is 'process'
+    (dlib holds the GIL, so this is the one that scales with cores) or
+    'thread'.
+    """
+
+    def __init__(self, tile_height=320, min_tile_size=60, workers=None,
+                 executor='process', separator_std=4.0):
+        self.tile_height = tile_height
+        self.min_tile_size = min_tile_size
+        self.separator_std = separator_std
+        if executor == 'process':
+            self.executor = ProcessPoolExecutor(workers)
+        else:
+            self.executor = ThreadPoolExecutor(workers)
+        self.tiles = None  # cached list of (top, right, bottom, left)
+        self._separators = None  # cached separator lines to check
+        self._shape = None
+
+    def _uniform(self, lines, axis):
+        return lines.std(axis=axis) < self.separator_std
+
+    def find_tiles(self, gray):
+        """
+        Return the tiles of a gray screenshot as (top, right, bottom, left)
+        boxes, searching the grid again only if the layout changed. Returns
+        None if there is no grid (less than two tiles).
+        """
+        if self.tiles is not None and gray.shape == self._shape:
+            rows, bands = self._separators
+            if self._uniform(gray[rows], 1).all() and all(
+                    self._uniform(gray[top:bottom, cols], 0).all()
+                    for top, bottom, cols in bands):
+                return self.tiles
+        self._shape = gray.shape
+        tiles = []
+        bands = []
+        row_mask = self._uniform(gray, 1)
+        for top, bottom in _runs(~row_mask, self.min_tile_size):
+            col_mask = self._uniform(gray[top:bottom], 0)
+            # a few lines are enough to notice a layout change
+            bands.append((top, bottom, np.flatnonzero(col_mask)[::4]))
+            for left, right in _runs(~col_mask, self.min_tile_size):
+                tiles.append((top, right, bottom, left))
+        if len(tiles) < 2:
+            # no grid (a single tile is the whole view): the separator
+            # lists would be empty and always look uniform, so there is
+            # nothing to cache
+            self.tiles = self._separators = None
+            return None
+        self._separators = (np.flatnonzero(row_mask)[::4], bands)
+        self.tiles = tiles
+        return tiles
+
+    def face_locations(self, frame, gray=None):
+        """
+        Find the faces on an RGB screenshot tile by tile. Returns the face
+        locations in screenshot coordinates.
+        """
+        if gray is None:
+            gray = cv.cvtColor(frame, cv.COLOR_RGB2GRAY)
+        tiles = self.find_tiles(gray)
+        if tiles is None:
+            return fr.face_locations(frame)
+        futures = []
+        for top, right, bottom, left in tiles:
+            scale = self.tile_height / (bottom - top)
+            futures.append(self.executor.submit(
+                detect_tile, frame[top:bottom, left:right], scale))
+        face_locations = []
+        for (top, right, bottom, left), future in zip(tiles, futures):
+            # map the boxes back to screenshot coordinates
+            for face_top, face_right, face_bottom, face_left in \
+                    future.result():
+                face_locations.append((face_top + top, face_right + left,
+                                       face_bottom + top, face_left + left))
+        return face_locations
+
+    def shutdown(self):
+        self.executor.shutdown()
@@ -0,0 +1,181 @@
+from itertools import count
+
+import cv2 as cv
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Intersection over union of every pair of boxes. Boxes are
+    (top, right, bottom, left) like fr.face_locations returns them.
+    Returns a (len(boxes_a) x len(boxes_b)) matrix.
+    """
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(1, -1, 4)
+    height = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    width = np.minimum(a[..., 1], b[..., 1]) - np.maximum(a[..., 3], b[..., 3])
+    intersection = np.clip(height, 0, None) * np.clip(width, 0, None)
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 1] - a[..., 3])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 1] - b[..., 3])
+    union = area_a + area_b - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection),
+                     where=union > 0)
+
+
+class Track:
+    """
+    One face followed from frame to frame. The identity (name, identity,
+    distance, encoding) is set once, when the face is encoded.
+    """
+    _ids = count(1)
+
+    def __init__(self, box):
+        self.id = next(self._ids)
+        self.box = np.array(box, dtype=np.float32)
+        self.name = None
+        self.identity = None  # index of the known face, -1 if unknown
+        self.distance = None
+        self.encoding = None
+        self.cluster = None  # id of the cluster of an unknown face
+        self.quality = None  # last decision of the quality gate
+        self.deferrals = 0  # how often the quality gate deferred encoding
+        self.points = None  # feature points followed by optical flow
+        self.misses = 0  # detections in a row that didn't find this track
+
+    def location(self):
+        return tuple(int(round(x)) for x in self.box)
+
+
+class FaceTracker:
+    """
+    Class that keeps face boxes following the faces between detections.
+
+    update() associates the boxes of a detection with the existing tracks
+    by IoU: matched tracks take the detected box, unmatched detections
+    start new tracks (those are the only ones that need encoding) and tracks
+    missed by max_misses detections in a row are dropped.
+    predict() moves every box on the frames in between with sparse
+    Lucas-Kanade optical flow of a few feature points inside the box. When
+    the flow loses the points of a track the tracker is marked lost, so
+    the caller can run the detection early.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_misses=1, max_points=20,
+                 min_points=4):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.max_points = max_points
+        self.min_points = min_points
+        self.tracks = []
+        self.lost = False
+        self._gray = None
+
+    def reset(self):
+        """Forget every track."""
+        self.tracks = []
+        self.lost = False
+        self._gray = None
+
+    def update(self, gray, locations):
+        """
+        Associate detected locations with the tracks on the gray frame they
+        were detected on. Returns the list of new tracks.
+        """
+        iou = box_iou(locations, [track.box for track in self.tracks])
+        matched_tracks = set()
+        matched_locations = set()
+        # greedy association, best overlaps first
+        for flat in np.argsort(-iou, axis=None):
+            row, col = np.unravel_index(flat, iou.shape)
+            if iou[row, col] < self.iou_threshold:
+                break
+            if row in matched_locations or col in matched_tracks:
+                continue
+            matched_locations.add(row)
+            matched_tracks.add(col)
+            track = self.tracks[col]
+            track.box[:] = locations[row]
+            track.misses = 0
+        tracks = []
+        for col, track in enumerate(self.tracks):
+            if col not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            tracks.append(track)
+        new_tracks = [Track(location) for row, location in enumerate(locations)
+                      if row not in matched_locations]
+        self.tracks = tracks + new_tracks
+        for track in self.tracks:
+            self._find_points(gray, track)
+        self._gray = gray
+        self.lost = False
+        return new_tracks
+
+    def _find_points(self, gray, track):
+        top, right, bottom, left = track.location()
+        mask = np.zeros_like(gray)
+        mask[max(top, 0):max(bottom, 0), max(left, 0):max(right, 0)] = 255
+        track.points = cv.goodFeaturesToTrack(gray, self.max_points, 0.01, 3,
+                                              mask=mask)
+
+    def predict(self, gray):
+        """Move the track boxes to the new gray frame."""
+        if self._gray is None or not self.tracks:
+            self._gray = gray
+            return
+        # boxes with too few features to follow just stay where they are
+        tracks = [track for track in self.tracks
+                  if track.points is not None
+                  and len(track.points) >= self.min_points]
+        if tracks:
+            # follow the points of all tracks with one optical flow call
+            points = np.concatenate([track.points for track in tracks])
+            new_points, status, _ = cv.calcOpticalFlowPyrLK(self._gray, gray,
+                                                            points, None)
+            status = status.ravel().astype(bool)
+            start = 0
+            for track in tracks:
+                end = start + len(track.points)
+                good = status[start:end]
+                old, new = points[start:end][good], new_points[start:end][good]
+                start = end
+                if len(new) < self.min_points:
+                    track.points = None
+                    self.lost = True
+                    continue
+                self._move_box(track, old.reshape(-1, 2), new.reshape(-1, 2))
+                track.points = new
+        self._gray = gray
+
+    @staticmethod
+    def _move_box(track, old, new):
+        # median shift of the points, scale from the change of their spread
+        dx, dy = np.median(new - old, axis=0)
+        old_spread = np.median(np.abs(old - np.median(old, axis=0)))
+        new_spread = np.median(np.abs(new - np.median(new, axis=0)))
+        scale = new_spread / old_spread if old_spread > 0 else 1
+        top, right, bottom, left = track.box
+        center_x = (left + right) / 2 + dx
+        center_y = (top + bottom) / 2 + dy
+        half_w = (right - left) / 2 * scale
+        half_h = (bottom - top) / 2 * scale
+        track.box[:] = (center_y - half_h, center_x + half_w,
+                        center_y + half_h, center_x - half_w)
+
+    def rescale(self, factor):
+        """
+        Scale the boxes to a screenshot resized by factor. The optical flow
+        needs a new start, so the tracker is marked lost.
+        """
+        for track in self.tracks:
+            track.box *= factor
+            track.points = None
+        self._gray = None
+        self.lost = True
+
+    def locations(self):
+        return [track.location() for track in self.tracks]
+
+    def names(self):
+        return [track.name for track in self.tracks]
@@ -0,0 +1,193 @@
+import hashlib
+import os
+from time import strftime, time
+
+import cv2 as cv
+import numpy as np
+
+from setup_class import (UNKNOWN_FOLDER, CacheEntry, load_encodings_cache,
+                         save_encodings_cache)
+
+
+def _area(location):
+    top, right, bottom, left = location
+    return (bottom - top) * (right - left)
+
+
+class UnknownFaces:
+    """
+    Online clustering of the faces that didn't match the known faces.
+
+    Every unknown face joins the closest cluster if its centroid is within
+    threshold, else it starts a new one. A cluster keeps the running mean
+    of its encodings, how often and when it was last seen, and the biggest
+    crop of the face as representative. The table has a fixed capacity;
+    when it is full the cluster seen least recently is dropped.
+
+    match() compares new faces with the centroids first, so a face that
+    belongs to a cluster of unknowns doesn't need to be searched in the
+    whole gallery again. Being close to a cluster alone doesn't make a
+    face a stranger (a bad first shot of a known person starts a cluster
+    too), so every cluster keeps a lower bound of the distance from its
+    centroid to the gallery. By the triangle inequality a face at distance
+    d from the centroid is farther than the tolerance from every known
+    face if the bound minus d is more than the tolerance; only then the
+    gallery is skipped. A moving centroid lowers the bound by the distance
+    it moved. clear() must be called when the gallery changes.
+
+    export() writes the representative crops into the UNKNOWN_FOLDER of a
+    class folder (setup_class() doesn't enroll them there) together with
+    their encodings_cache.npz entries. An image renamed to the name of the
+    person and moved into the class folder is enrolled without encoding it
+    again (the cache finds it by its content).
+    """
+
+    def __init__(self, capacity=1000, threshold=0.45, crop_margin=0.3,
+                 dim=128):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.crop_margin = crop_margin
+        self.centroids = np.zeros((capacity, dim), dtype=np.float32)
+        self.counts = np.zeros(capacity, dtype=np.int64)  # 0 - free slot
+        self.last_seen = np.zeros(capacity, dtype=np.float64)
+        self.ids = np.full(capacity, -1, dtype=np.int64)
+        self.crops = [None] * capacity  # (RGB crop, location in crop)
+        self._norms = np.zeros(capacity, dtype=np.float32)
+        # lower bound of the distance from the centroid to the gallery
+        self.gallery_distances = np.zeros(capacity, dtype=np.float32)
+        self._next_id = 0
+        self.hits = 0  # faces resolved by the clusters
+        self.evictions = 0
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts))
+
+    def clear(self):
+        self.counts[:] = 0
+        self.ids[:] = -1
+        self.crops = [None] * self.capacity
+
+    def match(self, face_encodings, tolerance):
+        """
+        Return (slots, distances) of the closest cluster of every face
+        encoding; slot is -1 if no cluster is within threshold or if the
+        face could still match a known face within tolerance.
+        """
+        slots, distances = self._nearest(face_encodings)
+        found = slots >= 0
+        found[found] = self.gallery_distances[slots[found]] \
+            - distances[found] > tolerance
+        slots[~found] = -1
+        self.hits += int(np.count_nonzero(found))
+        return slots, distances
+
+    def _nearest(self, face_encodings):
+        faces = np.asarray(face_encodings, dtype=np.float32).reshape(
+            -1, self.centroids.shape[1])
+        slots = np.full(len(faces), -1, dtype=np.intp)
+        distances = np.full(len(faces), np.inf, dtype=np.float32)
+        used = np.flatnonzero(self.counts)
+        if not len(faces) or not len(used):
+            return slots, distances
+        squared = np.einsum('ij,ij->i', faces, faces)[:, None] \
+            + self._norms[None, used] - 2 * faces @ self.centroids[used].T
+        nearest = np.argmin(squared, axis=1)
+        nearest_distances = np.sqrt(np.maximum(
+            squared[np.arange(len(faces)), nearest], 0))
+        found = nearest_distances <= self.threshold
+        slots[found] = used[nearest[found]]
+        distances[found] = nearest_distances[found]
+        return slots, distances
+
+    def crop(self, frame, location):
+        """Cut face location out of frame with a margin around it."""
+        top, right, bottom, left = location
+        margin = int(self.crop_margin * max(bottom - top, right - left))
+        crop_top, crop_left = max(0, top - margin), max(0, left - margin)
+        crop = frame[crop_top:bottom + margin, crop_left:right + margin].copy()
+        return crop, (top - crop_top, right - crop_left,
+                      bottom - crop_top, left - crop_left)
+
+    def add(self, encoding, frame=None, location=None, slot=-1,
+            timestamp=None, gallery_distance=0):
+        """
+        Add an unknown face to cluster slot (or to the closest cluster if
+        slot is -1) and return the id of its cluster. gallery_distance is
+        the distance of the face to the closest known face, a new cluster
+        starts with it as bound (0 - the gallery is never skipped). With
+        frame and location the face is cropped if it is bigger than the
+        current representative of the cluster.
+        """
+        encoding = np.asarray(encoding, dtype=np.float32)
+        if slot < 0:
+            slot = self._nearest([encoding])[0][0]
+        if slot < 0:
+            slot = self._free_slot()
+            self.centroids[slot] = encoding
+            self.counts[slot] = 1
+            self.ids[slot] = self._next_id
+            self.crops[slot] = None
+            self.gallery_distances[slot] = gallery_distance
+            self._next_id += 1
+        else:
+            self.counts[slot] += 1
+            shift = (encoding - self.centroids[slot]) / self.counts[slot]
+            self.centroids[slot] += shift
+            self.gallery_distances[slot] -= np.sqrt(shift @ shift)
+        self._norms[slot] = self.centroids[slot] @ self.centroids[slot]
+        self.last_seen[slot] = timestamp or time()
+        if frame is not None and location is not None:
+            current = self.crops[slot]
+            if current is None or _area(location) > _area(current[1]):
+                self.crops[slot] = self.crop(frame, location)
+        return int(self.ids[slot])
+
+    def _free_slot(self):
+        free = np.flatnonzero(self.counts == 0)
+        if len(free):
+            return free[0]
+        # drop the cluster seen least recently
+        self.evictions += 1
+        return int(np.argmin(self.last_seen))
+
+    def clusters(self, min_count=1):
+        """Return [(id, count, centroid)] of the clusters, biggest first."""
+        slots = np.flatnonzero(self.counts >= min_count)
+        slots = slots[np.argsort(-self.counts[slots], kind='stable')]
+        return [(int(self.ids[slot]), int(self.counts[slot]),
+                 self.centroids[slot].copy()) for slot in slots]
+
+    def export(self, path, min_count=3, prefix='unknown'):
+        """
+        Write the crops of the clusters seen at least min_count times as
+        <prefix>_<date>_<hash>.jpg into the UNKNOWN_FOLDER of class folder
+        path and add them to its encodings cache. Cluster ids start at 0 in
+        every session, so the name is made of the date and the content
+        hash of the image. Returns the written images relative to path.
+        """
+        os.makedirs(f'{path}/{UNKNOWN_FOLDER}', exist_ok=True)
+        cache = load_encodings_cache(path)
+        images = []
+        for slot in np.flatnonzero(self.counts >= min_count):
+            if self.crops[slot] is None:
+                continue
+            crop, location = self.crops[slot]
+            ok, data = cv.imencode('.jpg', cv.cvtColor(crop, cv.COLOR_RGB2BGR))
+            if not ok:
+                continue
+            data = data.tobytes()
+            # the same hash as file_hash() of the written image
+            hash_ = hashlib.sha1(data).hexdigest()
+            image = f'{UNKNOWN_FOLDER}/{prefix}_{strftime("%Y%m%d")}_' \
+                    f'{hash_[:10]}.jpg'
+            file_path = f'{path}/{image}'
+            with open(file_path, 'wb') as file:
+                file.write(data)
+            stat = os.stat(file_path)
+            cache[image] = CacheEntry(
+                stat.st_size, stat.st_mtime_ns, hash_, True,
+                self.centroids[slot].astype(np.float64),
+                tuple(int(x) for x in location))
+            images.append(image)
+        save_encodings_cache(path, cache)
+        return images
@@ -1,8 +1,10 @@
 import os
-from typing import List
+from typing import Dict, List, Set
 
 import openpyxl as xl
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import NamedStyle, Font, Alignment, PatternFill, Border, Side
+from openpyxl.utils import get_column_letter
 
 
 
@@ -91,6 +93,129 @@ def xlsx_file_write(path, data):
     print(f'Data saved into file {xlsx_file_path}!')
 
 
+def xlsx_file_read_stream(path: str) -> Dict[str, dict]:
+    """
+    Same as xlsx_file_read(), but streams the sheet once in read-only mode
+    instead of loading the whole workbook and walking it three times.
+    """
+    attendance_data = {}
+    xlsx_file_path = f'{path}/attendance.xlsx'
+    if not os.path.isfile(xlsx_file_path):
+        print('ERROR: There is no attendance.xlsx file!!!')
+        return attendance_data
+    work_book = xl.load_workbook(xlsx_file_path, read_only=True)
+    rows = work_book.active.iter_rows(values_only=True)
+    attendance_dates = list(next(rows, ())[1:])
+    for row in rows:
+        values = row[1:] + (None,) * (len(attendance_dates) - len(row) + 1)
+        attendance_data[row[0]] = dict(zip(attendance_dates, values))
+    work_book.close()
+    return attendance_data
+
+
+def _stream_styles(work_book):
+    # named styles have to be registered before cells use them
+    attendance_col_header_style(work_book)
+    attendance_row_header_style(work_book)
+    attendance_cell_style(work_book)
+    attendance_cell_style_absent(work_book)
+
+
+def _stream_row(work_sheet, row, first):
+    # style the cells like xlsx_file_write() does
+    cells = []
+    for index, value in enumerate(row):
+        cell = WriteOnlyCell(work_sheet, value=value)
+        if index == 0:
+            cell.style = 'attendance_row_header'
+        elif first:
+            cell.style = 'attendance_col_header'
+        elif value == 1:
+            cell.style = 'attendance_cell'
+        else:
+            cell.style = 'attendance_cell_absent'
+        cells.append(cell)
+    return cells
+
+
+def _update_widths(widths, row):
+    # same rule as xlsx_file_adjust_col_width(): only non-empty values count
+    for index, value in enumerate(row):
+        if value:
+            widths[index] = max(widths.get(index, 0), len(str(value)))
+
+
+def _stream_write(xlsx_file_path, rows, widths):
+    # rows is called for a fresh iterator, widths must be known before the
+    # first row is written in write-only mode
+    work_book = xl.Workbook(write_only=True)
+    work_sheet = work_book.create_sheet()
+    _stream_styles(work_book)
+    for index, width in widths.items():
+        work_sheet.column_dimensions[get_column_letter(index + 1)].width = \
+            width * 1.2
+    for number, row in enumerate(rows()):
+        work_sheet.append(_stream_row(work_sheet, row, number == 0))
+    # write to a temporary file first, so a crash never leaves half a file
+    temp_file_path = xlsx_file_path + '.tmp'
+    work_book.save(temp_file_path)
+    os.replace(temp_file_path, xlsx_file_path)
+
+
+def xlsx_file_write_stream(path: str, data: Dict[str, dict]) -> None:
+    """
+    Same output as xlsx_file_write(), written row by row with a write-only
+    workbook instead of building and restyling the whole sheet in memory.
+    """
+    xlsx_file_path = f'{path}/attendance.xlsx'
+
+    def rows():
+        dates = next(iter(data.values()), {})
+        yield ['NAMES'] + list(dates)
+        for name, attendances in data.items():
+            yield [name] + list(attendances.values())
+
+    widths = {}
+    for row in rows():
+        _update_widths(widths, row)
+    _stream_write(xlsx_file_path, rows, widths)
+    print(f'Data saved into file {xlsx_file_path}!')
+
+
+def xlsx_file_write_session(path: str, session: str, present: Set[str]) -> None:
+    """
+    Set the column of one session (1 for present names, 0 for the others)
+    in attendance.xlsx. The column is appended, or replaced if it exists.
+    The history is streamed from the old file to the new one row by row,
+    so memory use doesn't grow with the size of the sheet.
+    """
+    xlsx_file_path = f'{path}/attendance.xlsx'
+
+    def rows():
+        work_book = xl.load_workbook(xlsx_file_path, read_only=True)
+        try:
+            source_rows = work_book.active.iter_rows(values_only=True)
+            header = list(next(source_rows, ('NAMES',)))
+            column = header.index(session) if session in header \
+                else len(header)
+            if column == len(header):
+                header.append(session)
+            yield header
+            for row in source_rows:
+                row = list(row) + [None] * (len(header) - len(row))
+                row[column] = 1 if row[0] in present else 0
+                yield row
+        finally:
+            work_book.close()
+
+    # one streaming pass for the column widths, one for writing
+    widths = {}
+    for row in rows():
+        _update_widths(widths, row)
+    _stream_write(xlsx_file_path, rows, widths)
+    print(f'Data saved into file {xlsx_file_path}!')
+
+
 def xlsx_file_create_new(path: str, class_names: List[str]) -> None:
     # Create XLSX-file
     def create_xlsx_file():
@@ -167,7 +292,7 @@ def attendance_cell_style_absent(work_book):
         work_book.add_named_style(cell_style_absent)
 
 
-def attendance_col_header_style(work_book, work_sheet):
+def attendance_col_header_style(work_book, work_sheet=None):
     if 'attendance_col_header' not in work_book.named_styles:
         col_header_style = NamedStyle(name='attendance_col_header')
         col_header_style.font = Font(bold=True, size=12)
@@ -179,11 +304,12 @@ def attendance_col_header_style(work_book, work_sheet):
             bottom=Side(border_style='hair', color='FF000000'))
         work_book.add_named_style(col_header_style)
         # Set NamedStyle to 1st row
-        for cell in work_sheet['1:1']:
-            cell.style = 'attendance_col_header'
+        if work_sheet is not None:
+            for cell in work_sheet['1:1']:
+                cell.style = 'attendance_col_header'
 
 
-def attendance_row_header_style(work_book, work_sheet):
+def attendance_row_header_style(work_book, work_sheet=None):
     if 'attendance_row_header' not in work_book.named_styles:
         row_header_style = NamedStyle(name='attendance_row_header')
         row_header_style.font = Font(bold=True, size=12)
@@ -194,8 +320,9 @@ def attendance_row_header_style(work_book, work_sheet):
             bottom=Side(border_style='hair', color='FF000000'))
         work_book.add_named_style(row_header_style)
         # Set NamedStyle to 1st col
-        for cell in work_sheet['A']:
-            cell.style = 'attendance_row_header'
+        if work_sheet is not None:
+            for cell in work_sheet['A']:
+                cell.style = 'attendance_row_header'
 
 
 def xlsx_main(path, class_names):